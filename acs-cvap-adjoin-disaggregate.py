@@ -3,9 +3,13 @@ import warnings
 import pandas as pd
 import os
 from os import path
+from shutil import rmtree
 import maup
 
-from geometry import prorate
+from geometry import prorate, assign, read, write, filepath, downcast, upcast, tiled, proratetile, repair
+from config import settings
+from instrument import phase
+from store import Store
 
 """
 This script adjoins and disaggretates provided datasets from their parent
@@ -16,19 +20,43 @@ geometries (generally block groups) to blocks.
 # INITIAL SETUP #
 #################
 
-# Do we want to restart the whole process?
-restart = False
-
 # Set the state.
-state = 27
+state = settings.get("state", 27)
 
 # Set up some filenames.
-georoot = "../data/geometries/"
-demoroot = "../data/demographics/"
-outdir = path.join(georoot, "blocks-demo-adjoined")
-
-# Which years of CVAP data are we attaching?
-year = 2019
+georoot = settings.get("georoot", "../data/geometries/")
+demoroot = settings.get("demoroot", "../data/demographics/")
+
+# Format for the geometry files this script reads and writes: "parquet",
+# "feather", or "shp".
+fmt = settings.get("fmt", "parquet")
+outdir = filepath(georoot, "blocks-demo-adjoined", fmt)
+
+# Which years of ACS and CVAP data are we attaching? Every year is attached
+# and disaggregated in a single pass, sharing one assignment of blocks to block
+# groups.
+year = settings.get("year", 2019)
+years = settings.get("years", [year])
+
+# Do we want to store demographic data in 32-bit columns while we work? This
+# roughly halves the memory used by large block files; data are still written
+# to file at full precision.
+lean = settings.get("lean", False)
+
+# Do we want to process blocks county-by-county? Each county's blocks are
+# prorated in a separate process, against only the block groups nearby, so
+# memory use depends on the largest county rather than the whole state. When
+# blocks are stored as GeoParquet, each process reads only its own county's
+# blocks, and the output is written as a directory with one file per county.
+tiles = settings.get("tiled", False)
+processes = settings.get("processes", None)
+
+# Where do we keep the block store? Blocks are also written there, partitioned
+# by state and county, so later steps can read only the counties they need (see
+# `store.py`). Many states can share a store. Set to None to skip it. The
+# state's blocks are replaced only once there are new ones to write.
+store = settings.get("store", None)
+blockstore = Store(store) if store else None
 
 # Turn on progress bars.
 maup.progress.enabled = True
@@ -42,47 +70,113 @@ warnings.filterwarnings('ignore', 'GeoSeries.isna', UserWarning)
 ###############################################################
 
 # Load geographies, ACS data, and CVAP data.
-bgs_geo = gpd.read_file(path.join(georoot, "bgs"))
-bgs_acs = pd.read_csv(path.join(demoroot, "acs-joined.csv"))
-bgs_cvap = pd.read_csv(path.join(demoroot, "acs-cvap-transposed/bg-cvaps-t-2019.csv"))
-
-# Join ACS and CVAP data to geographies. First, ensure that the GEOID columns are
-# all the same type. Then, merge the lists on GEOIDs.
-bgs_geo["GEOID"] = bgs_geo["GEOID"].astype(bgs_acs["GEOID"].dtype)
-bgs_cvap["GEOID"] = bgs_cvap["geoid"].astype(bgs_acs["GEOID"].dtype)
-
-bgs = bgs_geo.merge(bgs_cvap, on="GEOID")
-bgs = bgs.merge(bgs_acs, on="GEOID")
+# Only the identifiers and weights attached to the geometries are used.
+weighting = ["GEOID", "TOTPOP10", "VAP10"]
+bgs_geo = read(filepath(georoot, "bgs", fmt), columns=weighting)
+bgs_geo = repair(bgs_geo, "block groups", processes=processes)
+with phase("read demographics"):
+	bgs_acs = pd.read_csv(path.join(demoroot, "acs-long.csv"))
+	bgs_acs = bgs_acs[bgs_acs["YEAR"].isin(years)]
+
+	# Name each year's CVAP columns by their line numbers alone, so every year
+	# shares them.
+	bgs_cvap = pd.concat([
+		pd.read_csv(path.join(demoroot, f"acs-cvap-transposed/bg-cvaps-t-{y}.csv"))
+			.rename(columns=lambda column: column.split("_")[0])
+			.assign(YEAR=y)
+		for y in years
+	])
+
+# Join ACS and CVAP data into a single table with a row for each block group and
+# year, and save it. Then, pivot it so each year's data are in their own
+# columns: ACS columns get the last two digits of their year (e.g. "TOTPOP19"),
+# and CVAP columns get the full year (e.g. "1_2019").
+with phase("join demographics", rows=len(bgs_geo)):
+	bgs_cvap["GEOID"] = bgs_cvap.pop("geoid").astype(bgs_acs["GEOID"].dtype)
+	bgs_long = bgs_acs.merge(bgs_cvap, on=["GEOID", "YEAR"])
+	bgs_long.to_csv(path.join(demoroot, "bgs-long.csv"), index=False)
+
+	measures = [column for column in list(bgs_long) if column not in {"GEOID", "YEAR"}]
+	cvap_measures = set(bgs_cvap) - {"GEOID", "YEAR"}
+	rename = lambda measure, y: f"{measure}_{y}" if measure in cvap_measures else f"{measure}{str(y)[-2:]}"
+
+	bgs_wide = bgs_long.pivot(index="GEOID", columns="YEAR")
+	bgs_wide.columns = [rename(measure, y) for measure, y in bgs_wide.columns]
+
+	# Ensure that the GEOID columns are the same type, then merge on GEOIDs.
+	bgs_geo["GEOID"] = bgs_geo["GEOID"].astype(bgs_acs["GEOID"].dtype)
+	bgs = bgs_geo.merge(bgs_wide.reset_index(), on="GEOID")
+	if lean: bgs = downcast(bgs)
 
 # Create a list of columns to disaggregate to blocks; we do this in separate
 # parts, weighting population differently than voting-age population.
-pop_columns = list(set(c for c in list(bgs_acs) if "VAP" not in c) - {"GEOID"})
-acsvap_columns = [column for column in list(bgs_acs) if "VAP" in column]
-cvap_columns = list(bgs_cvap)
-vap_columns = list(set(acsvap_columns + cvap_columns) - {"GEOID", "geoid"})
-
-# Load the block shapefile.
-blocks = gpd.read_file(path.join(georoot, "blocks"))
+pop_columns = [rename(m, y) for m in measures if m not in cvap_measures and "VAP" not in m for y in years]
+vap_columns = [rename(m, y) for m in measures if m in cvap_measures or "VAP" in m for y in years]
 
-# Prorate population data and (C)VAP data separately.
-blocks = prorate(blocks, bgs, "2010POP", "2010POP", columns=pop_columns)
-blocks = prorate(blocks, bgs, "2010VAP", "2010VAP", columns=vap_columns)
+# Each column's total population in its year, for validation.
+population = {rename(m, y): rename("TOTPOP", y) for m in measures for y in years}
 
 # Get all the columns we want.
 allcols = pop_columns + vap_columns + ["GEOID", "geometry"]
 
+# Assign blocks to block groups once, then prorate population data and (C)VAP
+# data separately using the same assignment. Because blocks nest inside block
+# groups, we match blocks to block groups on the first 12 digits of their GEOIDs
+# and only spatially assign blocks whose GEOIDs don't match.
+blockfile = filepath(georoot, "blocks", fmt)
+weights = [("TOTPOP10", pop_columns), ("VAP10", vap_columns)]
+
+if tiles:
+	# Prorate county-by-county, writing each county as it's finished and keeping
+	# only the sums of its columns.
+	source = blockfile if fmt == "parquet" else read(blockfile, columns=weighting)
+	pieces, totals = [], None
+	if fmt == "parquet":
+		if path.isdir(outdir): rmtree(outdir)
+		elif path.exists(outdir): os.remove(outdir)
+		os.makedirs(outdir)
+
+	with phase("prorate tiles") as record:
+		for n, (key, blocks) in enumerate(tiled(source, bgs, proratetile, load=weighting, processes=processes, weights=weights)):
+			blocks = upcast(gpd.GeoDataFrame(blocks[allcols], geometry="geometry"))
+			sums = blocks[pop_columns + vap_columns].sum()
+			totals = sums if totals is None else totals + sums
+			record["rows"] = (record["rows"] or 0) + len(blocks)
+
+			if fmt == "parquet": blocks.to_parquet(path.join(outdir, f"{key}.parquet"), index=False)
+			else: pieces.append(blocks)
+			if blockstore and n == 0: blockstore.clear(state)
+			if blockstore: blockstore.write(blocks)
+else:
+	blocks = read(blockfile, columns=weighting)
+	blocks = repair(blocks, "blocks", processes=processes)
+	if lean: blocks = downcast(blocks)
+
+	assignment = assign(blocks, bgs, by=("GEOID", "GEOID"))
+	for weight, columns in weights:
+		blocks = prorate(blocks, bgs, weight, weight, columns=columns, assignment=assignment)
+
+	totals = blocks[pop_columns + vap_columns].sum()
+
 # Ensures that we aren't straying too far from the real values, as well as
 # asserts that no column has a sum greater than the total population.
-for column in pop_columns + vap_columns:
-	print(column, abs(blocks[column].sum() - bgs[column].sum()))
+with phase("validate", rows=len(bgs)):
+	for column in pop_columns + vap_columns:
+		print(column, abs(totals[column] - bgs[column].sum()))
 
-	try: assert blocks[column].sum() <= blocks["TOTPOP19"].sum()
-	except AssertionError:
-		print(
-			f"The {column} column has a sum greater than the total population. "
-			f"Something isn't right."
-		)
+		try: assert totals[column] <= totals[population[column]]
+		except AssertionError:
+			print(
+				f"The {column} column has a sum greater than the total population. "
+				f"Something isn't right."
+			)
 
 # Write to file.
-if not path.exists(outdir): os.mkdir(outdir)
-gpd.GeoDataFrame(blocks[allcols], geometry="geometry").to_file(path.join(outdir))
+if not tiles:
+	blocks = upcast(gpd.GeoDataFrame(blocks[allcols], geometry="geometry"))
+	write(blocks, outdir)
+	if blockstore:
+		blockstore.clear(state)
+		blockstore.write(blocks)
+elif fmt != "parquet":
+	write(gpd.GeoDataFrame(pd.concat(pieces, ignore_index=True), geometry="geometry"), outdir)
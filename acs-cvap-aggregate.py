@@ -2,9 +2,18 @@
 import geopandas as gpd
 import warnings
 import numpy as np
+import pandas as pd
 import os
 from os import path
 import maup
+from shapely.geometry import box
+
+from geometry import read, write, filepath, downcast, upcast, tiled, aggregatetile, fields, repair, representatives, locate, fingerprints, crosswalks, assign, readjson, writejson
+from crosswalk import Crosswalk
+from config import settings
+from instrument import phase
+from pipeline import digest
+from store import Store
 
 """
 This script aggregates block-level demographic data up to desired geometries.
@@ -12,10 +21,16 @@ For example, the pre-filled values here aggregate Wisconsin block-level data up
 to wards.
 """
 
-# Set filepath roots.
-georoot = "../data/geometries/"
-indir = path.join(georoot, "wisconsin-wards-2020")
-outdir = path.join(georoot, "wisconsin-wards-2020-acs-adjoined")
+# Set the state FIPS code and filepath roots.
+state = settings.get("state", 55)
+georoot = settings.get("georoot", "../data/geometries/")
+indir = path.join(georoot, settings.get("target", "wisconsin-wards-2020"))
+
+# Format for the block file this script reads and the file it writes:
+# "parquet", "feather", or "shp".
+fmt = settings.get("fmt", "parquet")
+aggregated = settings.get("aggregated", "wisconsin-wards-2020-acs-adjoined")
+outdir = filepath(georoot, aggregated, fmt)
 
 # Turn on progress bars.
 maup.progress.enabled = True
@@ -24,30 +39,294 @@ maup.progress.enabled = True
 warnings.filterwarnings('ignore', 'GeoSeries.isna', UserWarning)
 
 # Do we want to include CVAP data?
-cvap = False
+cvap = settings.get("cvap", False)
+
+# Do we want to store block data in 32-bit columns while we work? Aggregated data
+# are still written to file at full precision.
+lean = settings.get("lean", False)
+
+# Do we want to split blocks which cross target boundaries among the targets
+# they overlap, in proportion to area? Otherwise, each block is assigned
+# wholesale to a single target. Intersections (and geometry repairs) are
+# computed in parallel, using up to `processes` worker processes (None uses
+# every processor).
+split = settings.get("fractional", False)
+processes = settings.get("processes", None)
+
+# Where do we keep the block-to-target crosswalk? Since it only depends on the
+# geometries, it can be reused to aggregate other data (e.g. another ACS year)
+# to the same targets without assigning blocks again. It's saved with the
+# blocks' GEOIDs and hashes of the targets' geometries, and only reused when
+# both match. Set to None to always assign blocks.
+crosswalkfile = settings.get("crosswalk", None)
+
+# Do we want to process blocks county-by-county? Each county's blocks are
+# aggregated in a separate process, against only the targets nearby, so memory
+# use depends on the largest county rather than the whole state. When blocks
+# are stored as GeoParquet, each process reads only its own county's blocks.
+# Crosswalks aren't saved in this mode.
+tiles = settings.get("tiled", False)
+
+# Where's the block store? If provided, blocks are read from the store rather
+# than the block file, and only this state's counties overlapping the existing
+# geometries are opened (see `store.py`), so a store shared by several states
+# never contributes a neighboring state's blocks.
+store = settings.get("store", None)
+blockstore = Store(store) if store else None
+
+# Do we want to assign each block to the target containing its representative
+# point, rather than the target it overlaps most? Representative points (and
+# areas) are cached for each block file and CRS, so aggregating to another set
+# of targets in the same CRS never reads, reprojects, or processes the block
+# geometries. Only applies when blocks aren't split, tiled, or read from the
+# block store.
+points = settings.get("points", False) and not (split or tiles or blockstore)
+
+# Do we want to aggregate to other layers of targets (e.g. municipalities and
+# districts) in the same run? Each layer is a dictionary with its own "target"
+# and "aggregated" names, like the ones above, e.g.
+#
+#	{"target": "wisconsin-senate-2020", "aggregated": "wisconsin-senate-2020-acs-adjoined"}
+#
+# Blocks are read and reprojected once, and assigned to every layer in
+# parallel. A layer made up of another layer's units (like municipalities made
+# up of wards) can set "from" to that layer's target, so it's aggregated from
+# that layer's totals rather than from blocks; its units are matched to the
+# finer units by equal values of the column named by "by", if provided, and
+# spatially otherwise.
+layers = settings.get("layers", [])
+
+# Where do we keep cached block points and incremental state (below)?
+cache = settings.get("cache", "./data/.cache/")
+
+# Do we want to aggregate incrementally? Each run records the targets' geometry
+# hashes, its crosswalk, and its aggregates in the cache's `aggregate/`. When
+# the blocks and settings haven't changed since, only the blocks intersecting
+# targets which were added, removed, or changed are read and assigned again,
+# and the previous aggregates are patched, so editing a few wards doesn't cost
+# a statewide reaggregation. Doesn't apply when blocks are tiled, or when
+# aggregating to other layers.
+incremental = settings.get("incremental", False) and not tiles and not layers
+statedir = path.join(cache, "aggregate", aggregated)
 
-# Read in existing data and blocks.
-existing = gpd.read_file(indir)
-blocks = gpd.read_file(path.join(georoot, "blocks-demo-adjoined")).to_crs(existing.crs)
+# Read in existing data, and find which block columns we want.
+existing = read(indir)
+blockfile = filepath(georoot, "blocks-demo-adjoined", fmt)
+if blockstore and str(state).zfill(2) not in blockstore.states():
+	raise ValueError(f"The block store at {store} has no blocks for state {state}; run acs-cvap-adjoin-disaggregate.py first.")
+names = blockstore.index(str(state).zfill(2))["columns"] if blockstore else fields(blockfile)
 
-# Get the columns we want.
-all_columns = list(set(list(blocks))-{"GEOID", "geometry"})
-nocvap_columns = list(set(c for c in list(blocks) if "_" not in c)-{"GEOID","geometry"})
+all_columns = list(set(names)-{"GEOID", "geometry"})
+nocvap_columns = list(set(c for c in names if "_" not in c)-{"GEOID","geometry"})
 columns = all_columns if cvap else nocvap_columns
 
-# Aggregate up to precincts.
-assignment = maup.assign(blocks, existing)
-existing[columns] = blocks[columns].groupby(assignment).sum()
+# Fix invalid geometries before assigning blocks to them. (Blocks were checked
+# when they were disaggregated.)
+existing = repair(existing, "targets", processes=processes)
+
+# Read the other layers. Layers aggregated from blocks are assigned in the
+# existing geometries' CRS, so blocks are only reprojected once; their own
+# geometries are written as they were read.
+others, projected = [], {}
+for i, layer in enumerate(layers):
+	targets = repair(read(path.join(georoot, layer["target"])), "targets", processes=processes)
+	others.append(targets)
+
+	if not layer.get("from"):
+		projected[i] = targets.to_crs(existing.crs) if targets.crs and existing.crs and targets.crs != existing.crs else targets
+
+# Find the targets which changed since the last incremental run, if it was run
+# on the same blocks with the same settings.
+previous, changed = None, None
+if incremental:
+	digests = path.join(statedir, "digests.json")
+	known = readjson(digests)
+
+	stamp = {
+		"blocks": digest(path.join(store, str(state).zfill(2)) if blockstore else blockfile, known),
+		"crs": existing.crs.to_wkt() if existing.crs else None,
+		"columns": sorted(columns),
+		"fractional": split,
+		"lean": lean,
+		"points": points
+	}
+	hashes = fingerprints(existing)
+
+	os.makedirs(statedir, exist_ok=True)
+	writejson(known, digests)
+
+	statefile = path.join(statedir, "state.json")
+	if path.exists(statefile):
+		if readjson(statefile) == stamp:
+			previous = read(path.join(statedir, "targets.parquet")).set_index("HASH")
+			walked = Crosswalk.load(path.join(statedir, "crosswalk.npz"))
+
+	if previous is not None:
+		removed = previous.index.difference(hashes)
+		added = ~hashes.isin(previous.index)
+		changed = gpd.GeoSeries(
+			pd.concat([previous.geometry.loc[removed], existing.geometry[added]], ignore_index=True),
+			crs=existing.crs
+		)
+		print(f"{len(removed)} targets removed and {added.sum()} added since the last run.")
+
+# Read only those columns, and only the blocks within the bounding boxes of the
+# existing geometries (and the other layers); blocks outside them can't be
+# assigned to any of them.
+if tiles and fmt == "parquet" and not blockstore:
+	blocks = None
+elif points:
+	blocks = read(blockfile, columns=["GEOID"] + columns, geometry=False)
+	located = representatives(blockfile, existing.crs, cache=path.join(cache, "points", ""))
+
+	# Only blocks whose points lie in changed targets need to be assigned again.
+	if changed is not None:
+		inside = np.unique(located.sindex.query(changed.values, predicate="intersects")[1])
+		blocks, located = blocks.iloc[inside], located.iloc[inside]
+	if lean: blocks = downcast(blocks)
+else:
+	# Only blocks intersecting changed targets need to be assigned again.
+	bounds = gpd.GeoSeries([box(*t.total_bounds) for t in [existing] + list(projected.values())], crs=existing.crs)
+	if changed is not None: bounds = changed
+	if changed is not None and changed.empty:
+		blocks = gpd.GeoDataFrame(columns=["GEOID"] + columns + ["geometry"], geometry="geometry", crs=existing.crs)
+	elif blockstore: blocks = blockstore.query(fips=state, mask=bounds, columns=["GEOID"] + columns)
+	else: blocks = read(blockfile, columns=["GEOID"] + columns, mask=bounds)
+	if lean: blocks = downcast(blocks)
+
+	# Reproject in place, so we don't hold two copies of the blocks.
+	with phase("reproject blocks", rows=len(blocks)):
+		blocks.to_crs(existing.crs, inplace=True)
 
-# Fill NaNs with 0.
-existing[columns] = existing[columns].fillna(0)
+# Aggregates of the layers aggregated from blocks, by layer.
+aggregates = {}
+
+if tiles:
+	# Aggregate county-by-county, summing each county's partial aggregates, as
+	# targets can span counties. Each layer is tiled separately.
+	source = blocks if blocks is not None else blockfile
+	for i, targets in [(None, existing)] + list(projected.items()):
+		summed, totals = None, None
+		with phase("aggregate tiles") as record:
+			results = tiled(source, targets, aggregatetile, load=columns, processes=processes, columns=columns, split=split)
+			for key, (partial, sums) in results:
+				summed = partial if summed is None else summed.add(partial, fill_value=0)
+				totals = sums if totals is None else totals.add(sums, fill_value=0)
+				record["rows"] = (record["rows"] or 0) + 1
+
+		aggregates[i] = summed.reindex(targets.index).fillna(0)
+
+	existing[columns] = aggregates.pop(None)
+else:
+	# Aggregate up to precincts. If we've saved a crosswalk for these blocks and
+	# targets, use it; otherwise, assign blocks to targets and save the result.
+	crosswalk = None
+	if crosswalkfile and previous is None:
+		geoids = pd.Index(blocks["GEOID"])
+		keys = hashes if incremental else fingerprints(existing)
+
+		if path.exists(crosswalkfile):
+			crosswalk = Crosswalk.load(crosswalkfile)
+			if crosswalk.source.equals(geoids) and crosswalk.target.equals(pd.Index(keys)):
+				crosswalk = crosswalk.relabel(blocks.index, existing.index)
+			else:
+				crosswalk = None
+
+	# Assign blocks to the existing geometries (unless we've saved the
+	# crosswalk) and to every other layer aggregated from blocks, all at once.
+	pending = ([existing] if crosswalk is None else []) + list(projected.values())
+	if pending:
+		with phase("assign blocks", rows=len(blocks) * len(pending)):
+			if blocks.empty:
+				walks = [Crosswalk.fromassignment(pd.Series(np.nan, index=blocks.index), t.index) for t in pending]
+			elif points:
+				walks = [Crosswalk.fromassignment(locate(located, t), t.index) for t in pending]
+			else:
+				walks = crosswalks(blocks, pending, split=split, processes=processes)
+
+		if crosswalk is None:
+			crosswalk, walks = walks[0], walks[1:]
+			if crosswalkfile and previous is None: crosswalk.relabel(geoids, keys).save(crosswalkfile)
+
+		with phase("aggregate layers", rows=len(blocks) * len(walks)):
+			for i, walk in zip(projected, walks):
+				aggregates[i] = walk.aggregate(blocks, columns).fillna(0)
+
+	if previous is None:
+		with phase("aggregate", rows=len(blocks)):
+			existing[columns] = crosswalk.aggregate(blocks, columns)
+
+			# Fill NaNs with 0.
+			existing[columns] = existing[columns].fillna(0)
+
+		totals = blocks[columns].sum()
+	else:
+		# Take the reassigned blocks' previous contributions out of the previous
+		# aggregates, and put their new contributions in.
+		with phase("patch aggregates", rows=len(blocks)):
+			keyed = blocks.set_index("GEOID")
+			crosswalk = crosswalk.relabel(keyed.index, hashes)
+			before = walked.restrict(keyed.index).aggregate(keyed, columns).reindex(hashes, fill_value=0)
+			after = crosswalk.aggregate(keyed, columns).reindex(hashes, fill_value=0)
+			patched = previous[columns].reindex(hashes, fill_value=0) - before + after
+
+			for column in columns:
+				dtype = previous[column].dtype
+				existing[column] = (patched[column].round() if pd.api.types.is_integer_dtype(dtype) else patched[column]).astype(dtype).to_numpy()
+
+		# The previous aggregates were validated when they were computed, and
+		# only a fraction of the blocks were read this time.
+		totals = None
+
+	# Record this run's targets, crosswalk, and aggregates, so the next one can
+	# be incremental. The stamp is removed first and written last, so an
+	# interrupted write is never mistaken for a usable state.
+	if incremental:
+		with phase("record aggregation state", rows=len(existing)):
+			if path.exists(statefile): os.remove(statefile)
+
+			walked = walked.replace(crosswalk, hashes) if previous is not None else crosswalk.relabel(blocks["GEOID"], hashes)
+			walked.save(path.join(statedir, "crosswalk.npz"))
+
+			targets = upcast(existing[columns + ["geometry"]].copy(), columns)
+			targets["HASH"] = hashes.to_numpy()
+			targets.to_parquet(path.join(statedir, "targets.parquet"), index=False)
+
+			writejson(stamp, statefile)
 
 # Assert that our columns are nearly equal.
-for column in columns:
-	try: assert np.isclose(existing[column].sum(), blocks[column].sum())
-	except AssertionError:print(f"The column {column} didn't sum properly.")
-
-# Fix geometries and write to file.
-existing["geometry"] = existing["geometry"].buffer(0)
-if not path.exists(outdir): os.mkdir(outdir)
-existing.to_file(outdir)
+with phase("validate", rows=len(existing)):
+	for column in columns if totals is not None else []:
+		try: assert np.isclose(existing[column].sum(), totals[column])
+		except AssertionError:print(f"The column {column} didn't sum properly.")
+
+# Write to file.
+write(upcast(existing, columns), outdir)
+
+# Aggregate the other layers, in order, and write each to file. Layers made up
+# of another layer's units are aggregated from that layer's totals.
+finished = {settings.get("target", "wisconsin-wards-2020"): existing}
+for i, (layer, targets) in enumerate(zip(layers, others)):
+	if layer.get("from"):
+		if layer["from"] not in finished:
+			raise ValueError(f"The layer {layer['target']} is aggregated from {layer['from']}, which has to be aggregated first.")
+
+		finer = finished[layer["from"]]
+		with phase("aggregate nested layer", rows=len(finer)):
+			by = layer.get("by")
+			nearby = targets.to_crs(finer.crs) if targets.crs and finer.crs and targets.crs != finer.crs else targets
+			# Values of a shared column match exactly; nothing is truncated.
+			assignment = assign(finer, nearby, by=(by, by) if by else None, drop=0, fallback=False)
+			targets[columns] = Crosswalk.fromassignment(assignment, targets.index).aggregate(finer, columns).fillna(0)
+			sums = finer[columns].sum()
+	else:
+		targets[columns] = aggregates[i]
+		sums = totals
+
+	with phase("validate", rows=len(targets)):
+		for column in columns if sums is not None else []:
+			try: assert np.isclose(targets[column].sum(), sums[column])
+			except AssertionError:print(f"The column {column} didn't sum properly for {layer['target']}.")
+
+	finished[layer["target"]] = targets
+	write(upcast(targets, columns), filepath(georoot, layer["aggregated"], fmt))
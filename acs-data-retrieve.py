@@ -1,90 +1,97 @@
 
 import pandas as pd
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from os import path
 
-from geometry import retrieve, reformat, variables
+from acs import requested, evaluate
+from census import retrieve, reformat
+from config import settings
+from instrument import phase
 
 """
-This script retrieves data from the ACS for the provided year, summary file
+This script retrieves data from the ACS for the provided years, summary file
 type, and variable names. Because Census block groups are the smallest level for
 which these statistics are reported, we attach a GEOID column to each row of
 data so it can be joined to its respective block groups later.
 """
 
 
-def suml(list):
-	"""
-	Concatenates a list of lists and returns the concatenated lists.
-	"""
-	l = []
-	for _l in list: l += _l
-	return l
-
-
 # Set the state FIPS code and some file locations.
-state = 55
-georoot = "./data/geometries/"
-demoroot = "./data/demographics/"
+state = settings.get("state", 55)
+georoot = settings.get("georoot", "./data/geometries/")
+demoroot = settings.get("demoroot", "./data/demographics/")
 
-# For which year of the ACS are we getting data?
-year = 2019
+# For which years of the ACS are we getting data? Each year is retrieved in
+# parallel, and the data for all of them are written to a single table with a
+# YEAR column.
+year = settings.get("year", 2019)
+years = settings.get("years", [year])
 
 # Set a column -> description mapping. Variable names can be found here:
-# https://api.census.gov/data/2019/acs/acs5/variables.html.
-columns = {
-	"B01001_001E": "TOTPOP19",
-	"B03002_003E": "WHITE19",
-	"B03002_004E": "BLACK19",
-	"B03002_005E": "AMIN19",
-	"B03002_006E": "ASIAN19",
-	"B03002_007E": "NHPI19",
-	"B03002_008E": "OTH19",
-	"B03002_009E": "2MORE19",
-	"B03002_002E": "NHISP19"
-}
-
-columngroups = {
-	"VAP19": variables("B01001", 7, 25, suffix="E") + variables("B01001", 31, 49, suffix="E"),
-}
+# https://api.census.gov/data/2019/acs/acs5/variables.html. Descriptions are
+# the same for every year; once the data are attached to geometries, the last
+# two digits of the year are appended to them (e.g. "TOTPOP19").
+columns = settings.get("columns", {
+	"B01001_001E": "TOTPOP",
+	"B03002_003E": "WHITE",
+	"B03002_004E": "BLACK",
+	"B03002_005E": "AMIN",
+	"B03002_006E": "ASIAN",
+	"B03002_007E": "NHPI",
+	"B03002_008E": "OTH",
+	"B03002_009E": "2MORE",
+	"B03002_002E": "NHISP"
+})
+
+# Derived columns, computed from the ACS variables above and from each other.
+# See `acs.py` for how these are specified; ranges of variables are expanded
+# with `census.variables`.
+derived = settings.get("derived", {
+	"VAP": {"sum": [["B01001", 7, 25], ["B01001", 31, 49]]},
+	"HISP": {"sum": ["TOTPOP"], "minus": ["NHISP"]}
+})
+
+# Every column we write, mapped to its definition.
+spec = {name: variable for variable, name in columns.items()}
+spec.update(derived)
 
 # Set the list of columns to retrieve.
-cols = ["GEO_ID"] + list(columns) + suml([columngroups[name] for name in columngroups])
+cols = ["GEO_ID"] + requested(spec)
 
-# Get the GEOIDs and attach them to the dataframe.
-bgs_acs = pd.DataFrame().append(
-	retrieve(
+
+def fetch(year):
+	"""
+	Retrieves a year of ACS data for every block group in the state, and
+	computes the columns we want.
+	"""
+	bgs_acs = retrieve(
 		state, year, dataset="acs5", cols=cols,
 		geometry=[("county", "*"), ("tract", "*"), ("block group", "*")]
 	)
-)
-
-# Go through each column and ensure that their sum is *not* 0.
-for column in list(bgs_acs):
-	try:
-		assert bgs_acs[column].sum() != 0
-	except AssertionError:
-		print(
-			f"The variable \"{column}\" appears to have returned no results. Please"
-			f"check that the \"{column}\" variable is reported at the geography "
-			f"level requested."
-		)
-
-# Sum the appropriate columns for calculating VAP.
-for column, group in columngroups.items():
-	summation = np.zeros(len(bgs_acs))
-	for subcolumn in group: summation += np.array(list(bgs_acs[subcolumn]))
-	bgs_acs[column] = list(summation)
-
-# Rename columns and fix GEOID column.
-colmap = {"GEO_ID": "GEOID"}
-colmap.update(columns)
-bgs_acs = reformat(bgs_acs, colmap=colmap)
-
-# Create a column for designating Hispanic and Latino population by subtracting
-# the "not Hispanic/Latino" column from the "total population" column.
-bgs_acs["HISP19"] = bgs_acs["TOTPOP19"] - bgs_acs["NHISP19"]
-
-# Trim off unnecessary columns and save to file.
-allcols = ["GEOID"] + list(columns.values()) + ["VAP19", "HISP19"]
-bgs_acs[allcols].to_csv(path.join(demoroot, "acs-joined.csv"), index=False)
+
+	# Go through each column and ensure that their sum is *not* 0.
+	for column in list(bgs_acs):
+		try:
+			assert bgs_acs[column].sum() != 0
+		except AssertionError:
+			print(
+				f"The variable \"{column}\" appears to have returned no results for "
+				f"{year}. Please check that the \"{column}\" variable is reported "
+				f"at the geography level requested."
+			)
+
+	# Compute every column at once, and fix the GEOID column.
+	with phase(f"derive columns {year}", rows=len(bgs_acs)):
+		bgs_acs = pd.concat([bgs_acs[["GEO_ID"]], evaluate(bgs_acs, spec)], axis=1)
+		bgs_acs = reformat(bgs_acs, colmap={})
+		bgs_acs.insert(1, "YEAR", year)
+
+	return bgs_acs
+
+
+with ThreadPoolExecutor(max_workers=len(years)) as pool:
+	bgs_acs = pd.concat(pool.map(fetch, years), ignore_index=True)
+
+# Save to file.
+allcols = ["GEOID", "YEAR"] + list(spec)
+bgs_acs[allcols].to_csv(path.join(demoroot, "acs-long.csv"), index=False)
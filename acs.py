@@ -0,0 +1,155 @@
+
+import numpy as np
+import pandas as pd
+
+from census import variables
+
+"""
+Derives columns from raw ACS variables using a declarative specification, which
+maps each derived column's name to an expression. An expression is either a
+single term, or a dictionary with any of the keys
+
+    "sum"       list of terms added together;
+    "minus"     list of terms subtracted; and
+    "over"      an expression the rest is divided by.
+
+A term is an ACS variable name (e.g. "B01001_001E"), the name of another
+column in the specification, or a range of variables given as a list of its
+`census.variables` arguments (e.g. ["B01001", 7, 25]). For example,
+
+    {
+        "TOTPOP19": "B01001_001E",
+        "NHISP19": "B03002_002E",
+        "HISP19": {"sum": ["TOTPOP19"], "minus": ["NHISP19"]},
+        "VAP19": {"sum": [["B01001", 7, 25], ["B01001", 31, 49]]},
+        "PVAP19": {"sum": ["VAP19"], "over": "TOTPOP19"}
+    }
+
+Since sums and differences are linear, every derived column's numerator and
+denominator are compiled into coefficient matrices over the raw variables, so
+all the columns are computed at once with two matrix products, however many
+variables they sum.
+"""
+
+
+def terms(expression):
+    """
+    Returns the (positive) terms and (negative) terms of an expression's
+    numerator, with ranges expanded.
+
+    :param expression: String, list, or dictionary; expression.
+    :return: Tuple of lists of names.
+    """
+    expand = lambda term: [term] if isinstance(term, str) else variables(*term)
+
+    if not isinstance(expression, dict):
+        return expand(expression), []
+
+    unknown = set(expression) - {"sum", "minus", "over"}
+    if unknown:
+        raise ValueError(f"Unknown keys in expression: {', '.join(sorted(unknown))}.")
+
+    plus = [name for term in expression.get("sum", []) for name in expand(term)]
+    minus = [name for term in expression.get("minus", []) for name in expand(term)]
+    return plus, minus
+
+
+def coefficients(expression, spec, resolving=()):
+    """
+    Returns the coefficient of each raw variable in an expression's numerator,
+    resolving references to other columns in the specification. References to
+    columns with denominators can't be resolved, as they aren't linear.
+
+    :param expression: String, list, or dictionary; expression.
+    :param spec: Dictionary; specification.
+    :param resolving: Tuple; names of the columns being resolved, used to
+        detect cycles; optional.
+    :return: Dictionary mapping raw variable names to coefficients.
+    """
+    plus, minus = terms(expression)
+    combined = {}
+
+    for sign, names in [(1, plus), (-1, minus)]:
+        for name in names:
+            # Variables which share a name with a column in the specification
+            # are still raw variables when they define that column.
+            if name in spec and spec[name] != name:
+                if name in resolving:
+                    raise ValueError(f"The column {name} is defined in terms of itself.")
+                if isinstance(spec[name], dict) and "over" in spec[name]:
+                    raise ValueError(f"The column {name} is a ratio, so it can't be added or subtracted.")
+                inner = coefficients(spec[name], spec, resolving + (name,))
+            else:
+                inner = {name: 1}
+
+            for variable, coefficient in inner.items():
+                combined[variable] = combined.get(variable, 0) + sign * coefficient
+
+    return combined
+
+
+def matrices(spec):
+    """
+    Compiles a specification into coefficient matrices over the raw variables.
+
+    :param spec: Dictionary; specification.
+    :return: Tuple of the raw variable names, the numerator matrix, and the
+        denominator matrix (with a column of zeros for columns which aren't
+        ratios), each with one row per raw variable and one column per derived
+        column.
+    """
+    numerators, denominators = [], []
+    for name, expression in spec.items():
+        numerators.append(coefficients(expression, spec, (name,)))
+        over = expression.get("over") if isinstance(expression, dict) else None
+        denominators.append(coefficients(over, spec, (name,)) if over is not None else {})
+
+    raw = list(dict.fromkeys(
+        variable for combination in numerators + denominators for variable in combination
+    ))
+    position = {variable: i for i, variable in enumerate(raw)}
+
+    numerator = np.zeros((len(raw), len(spec)), dtype=np.int64)
+    denominator = np.zeros((len(raw), len(spec)), dtype=np.int64)
+    for j, (top, bottom) in enumerate(zip(numerators, denominators)):
+        for variable, coefficient in top.items(): numerator[position[variable], j] = coefficient
+        for variable, coefficient in bottom.items(): denominator[position[variable], j] = coefficient
+
+    return raw, numerator, denominator
+
+
+def requested(spec):
+    """
+    Returns the raw ACS variables a specification needs.
+
+    :param spec: Dictionary; specification.
+    :return: List of variable names.
+    """
+    return matrices(spec)[0]
+
+
+def evaluate(df, spec):
+    """
+    Computes every column in a specification from a dataframe of raw ACS
+    variables. Columns which aren't ratios keep the raw variables' integer
+    type; ratios whose denominators are 0 are missing.
+
+    :param df: Dataframe of raw variables.
+    :param spec: Dictionary; specification.
+    :return: Dataframe of derived columns, indexed like the raw dataframe.
+    """
+    raw, numerator, denominator = matrices(spec)
+    values = df[raw].to_numpy()
+
+    top = values @ numerator
+    bottom = values @ denominator
+    ratios = denominator.any(axis=0)
+
+    derived = pd.DataFrame(top, index=df.index, columns=list(spec))
+    if ratios.any():
+        with np.errstate(divide="ignore", invalid="ignore"):
+            quotients = top[:, ratios] / bottom[:, ratios]
+        quotients[~np.isfinite(quotients)] = np.nan
+        derived[derived.columns[ratios]] = quotients
+
+    return derived
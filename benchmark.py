@@ -0,0 +1,317 @@
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import path
+
+"""
+Benchmarks the expensive steps of the pipeline on synthetic data, so changes to
+them can be measured without network access or real Census data. Blocks are
+unit squares on a grid; block groups are square tiles of blocks, with GEOIDs
+that nest like the Census's do; wards are larger tiles offset by half a block,
+so they split blocks along their edges like real wards do. A synthetic CVAP
+special tabulation is generated for the block groups.
+
+Each stage is run in a fresh process, and its wall time and peak memory are
+appended to a JSON results file along with the current commit, so results can
+be compared across versions. For example,
+
+    python benchmark.py --sizes 10000 100000 1000000
+    python benchmark.py --sizes 10000 --stages transpose prorate
+"""
+
+# Blocks per side of a block group, and of a ward.
+bgside = 4
+wardside = 10
+
+# Demographic columns attached to the synthetic geometries.
+columns = ["TOTPOP19", "WHITE19", "BLACK19", "HISP19", "VAP19"]
+
+
+def grid(blocks, seed=0):
+    """
+    Creates synthetic blocks, block groups, and wards.
+
+    :param blocks: Integer; approximate number of blocks.
+    :param seed: Integer; random seed; optional.
+    :return: Tuple of block, block group, and ward geodataframes.
+    """
+    import geopandas as gpd
+    import numpy as np
+    import shapely
+
+    rng = np.random.default_rng(seed)
+    side = bgside * max(1, round(math.sqrt(blocks) / bgside))
+
+    # Lay out the blocks and the block groups which contain them.
+    x, y = np.meshgrid(np.arange(side), np.arange(side))
+    x, y = x.ravel(), y.ravel()
+    bgx, bgy = x // bgside, y // bgside
+    bgsperrow = side // bgside
+    bg = bgy * bgsperrow + bgx
+
+    # Number block groups like the Census does: nine block groups per tract,
+    # a thousand tracts per county, all in state 55.
+    county, tract, digit = bg // 9000 + 1, bg // 9, bg % 9 + 1
+    bgids = 55 * 10**10 + county * 10**7 + (tract % 1000) * 10 + digit
+    bgids = bgids.astype(np.int64)
+    within = (y % bgside) * bgside + (x % bgside)
+    blockids = bgids * 1000 + within
+
+    blocks = gpd.GeoDataFrame(
+        {
+            "GEOID": blockids,
+            "TOTPOP10": rng.integers(0, 100, len(x)),
+        },
+        geometry=shapely.box(x, y, x + 1, y + 1)
+    )
+    blocks["VAP10"] = (blocks["TOTPOP10"] * rng.uniform(0.6, 0.9, len(x))).astype(int)
+    blocks["WARD"] = (y // wardside) * (side // wardside + 1) + x // wardside
+
+    # Block groups, with their demographic data.
+    order = np.unique(bg, return_index=True)[1]
+    bx, by = bgx[order], bgy[order]
+    bgs = gpd.GeoDataFrame(
+        {
+            "GEOID": bgids[order],
+            "TOTPOP10": blocks.groupby(bg)["TOTPOP10"].sum().values,
+            "VAP10": blocks.groupby(bg)["VAP10"].sum().values
+        },
+        geometry=shapely.box(bx * bgside, by * bgside, (bx + 1) * bgside, (by + 1) * bgside)
+    )
+    for column in columns:
+        bgs[column] = rng.integers(0, 1000, len(bgs))
+
+    # Wards, offset from the block grid by half a block.
+    cells = np.arange(-1, side // wardside + 1)
+    wx, wy = np.meshgrid(cells, cells)
+    wx, wy = wx.ravel() * wardside + 0.5, wy.ravel() * wardside + 0.5
+    wards = gpd.GeoDataFrame(geometry=shapely.box(wx, wy, wx + wardside, wy + wardside))
+    wards = wards[wards.intersects(shapely.box(0, 0, side, side))].reset_index(drop=True)
+
+    return blocks, bgs, wards
+
+
+def special(bgs, location, seed=0):
+    """
+    Writes a synthetic CVAP special tabulation file for the provided block
+    groups, with 13 lines per block group.
+
+    :param bgs: Geodataframe; block groups.
+    :param location: String; file to write.
+    :param seed: Integer; random seed; optional.
+    """
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    n = len(bgs)
+    estimates = rng.integers(0, 200, (n, 13))
+    estimates[:, 0] = estimates[:, 2:].sum(axis=1)
+
+    # Make some totals disagree with the sum of their parts.
+    estimates[rng.random(n) < 0.1, 0] += 1
+
+    geoids = np.repeat([f"15000US{g}" for g in bgs["GEOID"]], 13)
+    pd.DataFrame({
+        "geoname": "Block Group",
+        "lntitle": "Line",
+        "geoid": geoids,
+        "lnnumber": np.tile(np.arange(1, 14), n),
+        "tot_est": estimates.ravel(),
+        "cvap_est": estimates.ravel()
+    }).to_csv(location, index=False)
+
+
+def transpose(blocks, bgs, wards, scratch):
+    """
+    Reads and transposes a synthetic CVAP special tabulation.
+    """
+    import pandas as pd
+    from cvap import transpose
+
+    location = path.join(scratch, f"BlockGr-{len(bgs)}.csv")
+    if not path.exists(location): special(bgs, location)
+
+    cvaps = pd.read_csv(location, encoding="ISO-8859-1")
+    cvaps = cvaps[cvaps["geoid"].str.startswith("15000US55")]
+    return len(transpose(cvaps, 2019))
+
+
+def assignspatial(blocks, bgs, wards, scratch):
+    """
+    Spatially assigns blocks to block groups.
+    """
+    import maup
+    return len(maup.assign(blocks, bgs))
+
+
+def assigngeoid(blocks, bgs, wards, scratch):
+    """
+    Assigns blocks to block groups by GEOID.
+    """
+    from geometry import assign
+    return len(assign(blocks, bgs, by=("GEOID", "GEOID"), fallback=False))
+
+
+def prorate(blocks, bgs, wards, scratch):
+    """
+    Prorates block group data down to blocks.
+    """
+    from geometry import prorate
+    prorate(blocks, bgs, "TOTPOP10", "TOTPOP10", columns, by=("GEOID", "GEOID"))
+    return len(blocks)
+
+
+def dissolve(blocks, bgs, wards, scratch):
+    """
+    Dissolves blocks into wards by an attribute, summing some columns.
+    """
+    from geometry import dissolve
+    dissolve(blocks, join="WARD", columns=["TOTPOP10", "VAP10"])
+    return len(blocks)
+
+
+def aggregate(blocks, bgs, wards, scratch):
+    """
+    Aggregates block data up to wards, as `acs-cvap-aggregate.py` does.
+    """
+    from geometry import crosswalks
+    crosswalk, = crosswalks(blocks, [wards])
+    wards[["TOTPOP10", "VAP10"]] = crosswalk.aggregate(blocks, ["TOTPOP10", "VAP10"])
+    return len(blocks)
+
+
+def split(blocks, bgs, wards, scratch):
+    """
+    Aggregates block data up to wards, splitting blocks by area.
+    """
+    from geometry import crosswalks
+    crosswalk, = crosswalks(blocks, [wards], split=True)
+    wards[["TOTPOP10", "VAP10"]] = crosswalk.aggregate(blocks, ["TOTPOP10", "VAP10"])
+    return len(blocks)
+
+
+# Stages which can be benchmarked. Each takes the synthetic blocks, block groups,
+# wards, and a scratch directory, and returns the number of rows processed.
+stages = {
+    "transpose": transpose,
+    "assign-spatial": assignspatial,
+    "assign-geoid": assigngeoid,
+    "prorate": prorate,
+    "dissolve": dissolve,
+    "aggregate": aggregate,
+    "fractional": split
+}
+
+
+def measure(stage, size, scratch):
+    """
+    Builds synthetic data and times a single stage. Meant to be run in a fresh
+    process, so the peak memory reported isn't inflated by other stages: the
+    peak RSS includes the synthetic data, and the delta is how far the stage
+    raised it.
+
+    :param stage: String; name of the stage.
+    :param size: Integer; approximate number of blocks.
+    :param scratch: String; directory for generated files.
+    :return: Dictionary of measurements.
+    """
+    from instrument import memory
+
+    blocks, bgs, wards = grid(size)
+    _, before = memory()
+
+    start = time.perf_counter()
+    rows = stages[stage](blocks, bgs, wards, scratch)
+    seconds = time.perf_counter() - start
+    _, after = memory()
+
+    return {
+        "stage": stage,
+        "blocks": len(blocks),
+        "bgs": len(bgs),
+        "wards": len(wards),
+        "rows": rows,
+        "seconds": seconds,
+        "rowspersecond": rows / seconds if seconds > 0 else None,
+        "peakrss": after,
+        "peakrssdelta": after - before
+    }
+
+
+def revision():
+    """
+    Returns the current commit, so results can be compared across versions.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=path.dirname(path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, names=None, scratch="./scratch/benchmarks/", output=None, repeat=1):
+    """
+    Runs the benchmarks, each in its own process, and appends the results to the
+    output file.
+
+    :param sizes: List; approximate numbers of blocks.
+    :param names: List; stages to run. If not provided, every stage is run;
+        optional.
+    :param scratch: String; directory for generated files; optional.
+    :param output: String; JSON file to which results are appended. Defaults to
+        `benchmark-results.json` in the scratch directory; optional.
+    :param repeat: Integer; number of times each stage is run; optional.
+    :return: List of results.
+    """
+    os.makedirs(scratch, exist_ok=True)
+    output = output if output else path.join(scratch, "benchmark-results.json")
+    commit = revision()
+    results = []
+
+    for size in sizes:
+        for name in names if names else list(stages):
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                    result = pool.submit(measure, name, size, scratch).result()
+
+                result.update({
+                    "commit": commit,
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": platform.python_version(),
+                    "machine": platform.machine()
+                })
+                results.append(result)
+                print(
+                    f"{name} ({result['blocks']} blocks): {result['seconds']:.2f}s, "
+                    f"{result['peakrss'] / 1024**2:.0f}MB peak RSS"
+                )
+
+    previous = []
+    if path.exists(output):
+        with open(output) as f: previous = json.load(f)
+    with open(output, "w") as f: json.dump(previous + results, f, indent=2)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks pipeline steps on synthetic data.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000], help="Approximate numbers of blocks.")
+    parser.add_argument("--stages", nargs="+", choices=list(stages), help="Stages to benchmark.")
+    parser.add_argument("--scratch", default="./scratch/benchmarks/", help="Directory for generated files.")
+    parser.add_argument("--output", help="JSON file to which results are appended.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times each stage is run.")
+    args = parser.parse_args()
+
+    run(args.sizes, args.stages, args.scratch, args.output, args.repeat)
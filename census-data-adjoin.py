@@ -1,9 +1,10 @@
 
-import geopandas as gpd
-import pandas as pd
 from os import path
 
-from geometry import retrieve, reformat
+from census import retrieve, reformat
+from geometry import read, write, filepath
+from config import settings
+from instrument import phase
 
 """
 This script retrieves population data (and other selected variables, if desired)
@@ -14,31 +15,32 @@ back up to other geometries.
 """
 
 # File locations.
-georoot = "./data/geometries/"
+georoot = settings.get("georoot", "./data/geometries/")
 
-# Set the state FIPS.
-state = 27
+# Format for the geometry files this script writes: "parquet", "feather", or
+# "shp". Columnar formats are much faster for later steps to read.
+fmt = settings.get("fmt", "parquet")
 
-# Create initial dataframes.
-bgs_census = pd.DataFrame()
-blocks_census = pd.DataFrame()
+# Set the state FIPS.
+state = settings.get("state", 27)
 
 # Retrieve Census data for block/groups.
-bgs_census = bgs_census.append(retrieve(
+bgs_census = retrieve(
 	state, 2010, dataset="sf1",
 	geometry=[("county", "*"), ("tract", "*"), ("block group", "*")],
 	cols=["GEO_ID", "P010001", "P008001"]
-))
+)
 
-blocks_census = blocks_census.append(retrieve(
+blocks_census = retrieve(
 	state, 2010, dataset="sf1",
 	geometry=[("county", "*"), ("tract", "*"), ("block", "*")],
 	cols=["GEO_ID", "P010001", "P008001"]
-))
+)
 
-# Load block/group geometries.
-bgs = gpd.read_file(path.join(georoot, "bgs"))
-blocks = gpd.read_file(path.join(georoot, "blocks"))
+# Load block/group geometries. When we aren't overwriting the original
+# shapefiles, only read the identifiers the later steps use.
+bgs = read(path.join(georoot, "bgs"), columns=None if fmt == "shp" else ["GEOID"])
+blocks = read(path.join(georoot, "blocks"), columns=None if fmt == "shp" else ["GEOID10"])
 
 # Reformat the dataframes so they have proper column identifiers and indices.
 # Then, adjoin that data to the block groups and blocks we found earlier.
@@ -51,12 +53,13 @@ blocks_census = reformat(
 )
 
 # Merge data.
-bgs["GEOID"] = bgs["GEOID"].astype(int)
-bgs = bgs.merge(bgs_census, on="GEOID")
+with phase("merge", rows=len(bgs) + len(blocks)):
+	bgs["GEOID"] = bgs["GEOID"].astype(int)
+	bgs = bgs.merge(bgs_census, on="GEOID")
 
-blocks["GEOID"] = blocks["GEOID10"].astype(int)
-blocks = blocks.merge(blocks_census, on="GEOID")
+	blocks["GEOID"] = blocks["GEOID10"].astype(int)
+	blocks = blocks.merge(blocks_census, on="GEOID")
 
-# Write to file.
-bgs.to_file(path.join(georoot, "bgs"))
-blocks.to_file(path.join(georoot, "blocks"))
+# Write to file. If we're writing shapefiles, this overwrites the originals.
+write(bgs, filepath(georoot, "bgs", fmt))
+write(blocks, filepath(georoot, "blocks", fmt))
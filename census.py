@@ -0,0 +1,302 @@
+
+import hashlib
+import json
+import os
+import threading
+import time
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from http.client import IncompleteRead
+from os import path
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+from instrument import phase
+
+"""
+A small client for the Census API. Responses are cached on disk, keyed by
+dataset, year, geography, and variables, so rerunning a script doesn't hit the
+API again. Requests for geographies below the county level are split up by
+county and sent concurrently, requests for more variables than the API allows
+in a single call are split up and rejoined, and failed requests are retried
+with exponential backoff.
+"""
+
+# Where the API lives. Point this at a local server to test against canned
+# responses.
+base = "https://api.census.gov/data"
+
+# Maps dataset names (as used by `censusdata`) to their API paths.
+datasets = {
+    "acs1": "acs/acs1",
+    "acs3": "acs/acs3",
+    "acs5": "acs/acs5",
+    "sf1": "dec/sf1",
+    "pl": "dec/pl"
+}
+
+# The API refuses calls for more than 50 variables; the geography columns it
+# adds to every response don't count.
+limit = 50
+
+
+def download(
+        dataset,
+        year,
+        geography,
+        cols,
+        cache="./data/.cache/census/",
+        workers=8,
+        retries=5,
+        backoff=1,
+        key=None,
+        url=None,
+        timeout=60
+    ):
+    """
+    Retrieves data from the Census API.
+
+    :param dataset: String; Census dataset from which we retrieve data.
+    :param year: Integer; year for which we retrieve data.
+    :param geography: List; (level, value) pairs identifying the geography,
+        e.g. `[("state", "55"), ("county", "*"), ("block group", "*")]`.
+    :param cols: List; variables to retrieve.
+    :param cache: String; directory in which responses are cached. If None,
+        responses aren't cached; optional.
+    :param workers: Integer; maximum number of concurrent requests; optional.
+    :param retries: Integer; number of times a failed request is retried;
+        optional.
+    :param backoff: Number; seconds to wait before the first retry, doubled
+        after each subsequent one; optional.
+    :param key: String; Census API key; optional.
+    :param url: String; API root, overriding `base`; optional.
+    :param timeout: Number; seconds to wait on a stalled connection before
+        retrying; optional.
+    :return: Dataframe with one column per variable.
+    """
+    url = url if url else base
+    name = f"{year}/{datasets.get(dataset, dataset)}"
+    fetch = lambda params: request(url, name, params, cache, retries, backoff, key, timeout)
+
+    # If we're asking for every county's worth of some smaller geography, ask
+    # for each county separately: these requests are smaller, less likely to
+    # fail, and can be sent at the same time.
+    levels = [level for level, _ in geography]
+    geographies = [geography]
+
+    if "county" in levels[:-1] and dict(geography)["county"] == "*":
+        parents = geography[:levels.index("county")]
+        counties = fetch(query(parents + [("county", "*")], ["NAME"]))
+        geographies = [
+            [(level, county if level == "county" else value) for level, value in geography]
+            for county in counties["county"]
+        ]
+
+    # Split the variables into groups the API will accept.
+    chunks = [cols[i:i+limit] for i in range(0, len(cols), limit)]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            [pool.submit(fetch, query(g, chunk)) for chunk in chunks]
+            for g in geographies
+        ]
+        frames = [join([f.result() for f in fs], levels) for fs in futures]
+
+    data = pd.concat(frames, ignore_index=True)
+    data = data[cols]
+
+    # Everything comes back as strings, so convert whatever is numeric.
+    for col in cols:
+        numeric = pd.to_numeric(data[col], errors="coerce")
+        if numeric.notna().sum() == data[col].notna().sum():
+            data[col] = numeric
+
+    return data
+
+
+def query(geography, cols):
+    """
+    Creates the query parameters for a request.
+
+    :param geography: List; (level, value) pairs identifying the geography.
+    :param cols: List; variables to retrieve.
+    :return: Dictionary of query parameters.
+    """
+    *parents, (level, value) = geography
+    params = {"get": ",".join(cols), "for": f"{level}:{value}"}
+    if parents: params["in"] = " ".join(f"{l}:{v}" for l, v in parents)
+
+    return params
+
+
+def join(frames, levels):
+    """
+    Joins responses for different groups of variables on their geography
+    columns.
+
+    :param frames: List; dataframes for the same geography.
+    :param levels: List; geography levels.
+    :return: Dataframe.
+    """
+    joined = frames[0]
+    for frame in frames[1:]:
+        on = [level for level in levels if level in list(frame)]
+        frame = frame[[c for c in list(frame) if c not in list(joined) or c in on]]
+        joined = joined.merge(frame, on=on)
+
+    return joined
+
+
+def header(params):
+    """
+    Creates the header the API would send for the provided query parameters.
+    Used when the API responds with no content.
+
+    :param params: Dictionary; query parameters.
+    :return: List of column names.
+    """
+    parents = [level.split(":")[0] for level in params.get("in", "").split(" ") if level]
+    return params["get"].split(",") + parents + [params["for"].split(":")[0]]
+
+
+def request(url, name, params, cache=None, retries=5, backoff=1, key=None, timeout=60):
+    """
+    Sends a single request to the Census API, reading it from and writing it to
+    the cache if one is provided. Retries with exponential backoff when the
+    request fails, times out, or the connection drops partway through.
+
+    :param url: String; API root.
+    :param name: String; year and dataset path, e.g. "2019/acs/acs5".
+    :param params: Dictionary; query parameters.
+    :param cache: String; cache directory; optional.
+    :param retries: Integer; number of retries; optional.
+    :param backoff: Number; seconds before the first retry; optional.
+    :param key: String; Census API key; optional.
+    :param timeout: Number; seconds to wait on a stalled connection; optional.
+    :return: Dataframe of the response.
+    """
+    # The cache key doesn't include the API key or the API root, so the same
+    # cache can be used with or without a key.
+    identifier = json.dumps([name, params], sort_keys=True)
+    location = None
+
+    if cache:
+        digest = hashlib.sha256(identifier.encode()).hexdigest()
+        location = path.join(cache, f"{digest}.json")
+
+        if path.exists(location):
+            with open(location) as f: rows = json.load(f)
+            return pd.DataFrame(rows[1:], columns=rows[0])
+
+    arguments = dict(params, key=key) if key else params
+    address = f"{url}/{name}?{urlencode(arguments)}"
+
+    for attempt in range(retries+1):
+        try:
+            with urlopen(address, timeout=timeout) as response:
+                body = response.read().decode()
+            rows = json.loads(body) if body else [header(params)]
+            break
+        except (HTTPError, URLError, IncompleteRead, ConnectionError, TimeoutError, json.JSONDecodeError) as e:
+            # Don't retry requests the API says are malformed.
+            if isinstance(e, HTTPError) and 400 <= e.code < 500 and e.code != 429:
+                raise
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+    if location:
+        os.makedirs(cache, exist_ok=True)
+        temporary = f"{location}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "w") as f: json.dump(rows, f)
+        os.replace(temporary, location)
+
+    return pd.DataFrame(rows[1:], columns=rows[0])
+
+
+def retrieve(
+        fips,
+        year,
+        dataset="acs5",
+        geometry=[],
+        cols=["B01001_001E", "GEO_ID"],
+        **kwargs
+    ):
+    """
+    Retrieves data from the census API. Responses are cached on disk, and
+    requests for geographies within counties are sent county-by-county in
+    parallel; see `download`.
+
+    :param fips: Integer; state FIPS houston from which we retrieve data.
+    :param year: Integer; year for which we retrieve data.
+    :param dataset: String; Census dataset from which we retrieve data.
+    :param geometry: String; geometry for which we retrieve data.
+    :param cols: List; columns of data to retrieve.
+    :param kwargs: Passed to `census.download`, e.g. the cache directory or
+        number of concurrent requests; optional.
+    :return: Properly-formatted dataframe.
+    """
+    with phase(f"retrieve {dataset} {year}") as record:
+        data = download(
+            dataset,
+            year,
+            [("state", str(fips).zfill(2))] + geometry,
+            cols,
+            **kwargs
+        )
+        record["rows"] = len(data)
+
+    return data
+
+
+def reformat(df, geo=("GEO_ID", "GEOID"), colmap={"B01001_001E": "TOTPOP"}):
+    """
+    Reformats census api data into a more familiar format.
+
+    :param df: Dataframe.
+    :param geo: Tuple; header to replace, and replacement header.
+    :param colmap: Dictionary; maps old header names to new ones.
+    :return: Modified dataframe.
+    """
+    # Properly format all the geoids so they don't have that annoying tag on the
+    # front.
+    geo_source, geo_target = geo
+    df[geo_target] = df[geo_source].apply(lambda g: int(g.split("US")[1]))
+
+    # Set the index to be the "GEOID" column, but immediately reset the index
+    # so we just get the index to be {1, ..., n}.
+    df = df.set_index(geo_target)
+    df = df.reset_index()
+
+    # Delete old column.
+    del df[geo_source]
+
+    # Rename the column(s) appropriately.
+    df = df.rename(columns=colmap)
+
+    return df
+
+
+def variables(prefix, start, stop, suffix="E"):
+    """
+    Returns the ACS variable names from the provided prefix, start, stop, and
+    suffix parameters. Used to generate batches of names, especially for things
+    like voting-age population. Variable names are formatted in the following
+    way:
+
+                    <prefix>_<number identifier><suffix>
+
+    where <prefix> is a population grouping, <number identifier> is the number
+    of the variable in that grouping, and <suffix> designates the file used.
+
+    :param str prefix: Population grouping; typically "B01001".
+    :param int start: Where to start numbering.
+    :param int stop: Where to stop numbering. Inclusive.
+    :param str suffix: Suffix designating the file. For most purposes, this is
+        "E".
+    """
+    return [
+        f"{prefix}_{str(t).zfill(3)}{suffix}"
+        for t in range(start, stop+1)
+    ]
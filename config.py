@@ -0,0 +1,96 @@
+
+import argparse
+import json
+import os
+import sys
+from os import path
+
+"""
+Parameters for the data preparation scripts. When a script is run by the
+pipeline runner (or by hand with the PREP_CONFIG environment variable set to the
+location of a JSON file), parameters are read from that file; anything not in
+the file falls back to the default written in the script itself, e.g.
+
+    state = settings.get("state", 55)
+
+Each script is also a command-line entry point for its stage, taking a config
+file and any parameters as flags, which override the file's, e.g.
+
+    python acs-data-retrieve.py --config config.json --state 27 --years [2018,2019]
+    python acs-cvap-aggregate.py --target minnesota-precincts-2020 --cvap true
+
+Flag values are read as JSON where they can be (so `true`, `2019`, and
+`[2018,2019]` are a boolean, a number, and a list) and as strings otherwise.
+`--help` lists the parameters the pipeline tracks for the stage, but any
+parameter a script reads can be set.
+"""
+
+
+def value(text):
+    """
+    Reads a flag's value as JSON, or as a string if it isn't valid JSON.
+
+    :param text: String; value.
+    :return: Value.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def parse(name, tracked, arguments):
+    """
+    Parses a stage script's command-line arguments.
+
+    :param name: String; name of the stage.
+    :param tracked: List; parameters the pipeline tracks for the stage.
+    :param arguments: List; command-line arguments.
+    :return: Dictionary of parameters, including those in the config file.
+    """
+    parser = argparse.ArgumentParser(
+        prog=f"{name}.py",
+        description=f"Runs the {name} stage of the data preparation pipeline.",
+        epilog="Other parameters the script reads can be set the same way."
+    )
+    parser.add_argument("--config", help="JSON file of parameters.")
+    for parameter in tracked:
+        parser.add_argument(f"--{parameter}", type=value, metavar="VALUE", default=argparse.SUPPRESS)
+
+    known, extra = parser.parse_known_args(arguments)
+    parameters = vars(known)
+
+    # Parameters the runner doesn't track are set the same way.
+    while extra:
+        flag = extra.pop(0)
+        if not flag.startswith("--") or flag == "--":
+            parser.error(f"unrecognized argument: {flag}")
+
+        key, _, text = flag[2:].partition("=")
+        if not _:
+            if not extra or extra[0].startswith("--"):
+                parser.error(f"argument {flag}: expected a value")
+            text = extra.pop(0)
+        parameters[key] = value(text)
+
+    overrides = {key: v for key, v in parameters.items() if key != "config"}
+    if not parameters.get("config"):
+        return overrides
+
+    with open(parameters["config"]) as f:
+        return dict(json.load(f), **overrides)
+
+
+settings = {}
+
+if os.environ.get("PREP_CONFIG"):
+    with open(os.environ["PREP_CONFIG"]) as f: settings = json.load(f)
+
+# When a stage script is run directly, read its command-line arguments. (Worker
+# processes started by the script see the same arguments.) The pipeline runner
+# imports nothing heavy, so this stays cheap.
+main = getattr(sys.modules.get("__main__"), "__file__", None)
+if main and path.dirname(path.abspath(main)) == path.dirname(path.abspath(__file__)):
+    from pipeline import stages
+    stage = path.splitext(path.basename(main))[0]
+    if stage in stages: settings.update(parse(stage, stages[stage]["parameters"], sys.argv[1:]))
@@ -0,0 +1,224 @@
+
+import numpy as np
+import os
+import pandas as pd
+import threading
+from scipy import sparse
+
+
+class Crosswalk:
+    """
+    A sparse matrix relating source units (e.g. blocks) to the target units
+    (e.g. block groups or wards) they belong to. Entry (i, j) is the share of
+    source unit i that lies in target unit j: 1 when sources are assigned
+    wholesale, and a fraction when they're split. Aggregating or disaggregating
+    every column of a dataframe is then a single sparse matrix multiplication,
+    and since the crosswalk only depends on the geometries, it can be saved and
+    reused for any data attached to them.
+    """
+
+    def __init__(self, matrix, source, target):
+        """
+        :param matrix: Sparse matrix with one row per source unit and one column
+            per target unit.
+        :param source: Index; labels of the source units.
+        :param target: Index; labels of the target units.
+        """
+        self.matrix = sparse.csr_matrix(matrix)
+        self.source = pd.Index(source)
+        self.target = pd.Index(target)
+
+    @classmethod
+    def fromassignment(cls, assignment, target):
+        """
+        Creates a crosswalk from an assignment of source units to target units,
+        like the ones returned by `maup.assign` and `geometry.assign`.
+        Unassigned source units belong to no target.
+
+        :param assignment: Series mapping source labels to target labels.
+        :param target: Index; labels of the target units.
+        :return: Crosswalk.
+        """
+        target = pd.Index(target)
+        assigned = assignment.notna().to_numpy()
+        rows = np.flatnonzero(assigned)
+        cols = target.get_indexer(assignment[assigned])
+
+        if (cols < 0).any():
+            raise ValueError("The assignment refers to target units which don't exist.")
+
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)), shape=(len(assignment), len(target))
+        )
+
+        return cls(matrix, assignment.index, target)
+
+    @classmethod
+    def fromweights(cls, sources, targets, weights, source, target):
+        """
+        Creates a crosswalk from (source, target, weight) triples, e.g. the
+        share of each source unit's area in each target unit it overlaps.
+
+        :param sources: Array; source label of each triple.
+        :param targets: Array; target label of each triple.
+        :param weights: Array; weight of each triple.
+        :param source: Index; labels of every source unit.
+        :param target: Index; labels of every target unit.
+        :return: Crosswalk.
+        """
+        source, target = pd.Index(source), pd.Index(target)
+        rows, cols = source.get_indexer(sources), target.get_indexer(targets)
+
+        if (rows < 0).any() or (cols < 0).any():
+            raise ValueError("The weights refer to units which don't exist.")
+
+        matrix = sparse.csr_matrix(
+            (np.asarray(weights, dtype=float), (rows, cols)),
+            shape=(len(source), len(target))
+        )
+
+        return cls(matrix, source, target)
+
+    def relabel(self, source=None, target=None):
+        """
+        Returns the same crosswalk with new labels for its source or target
+        units, e.g. GEOIDs in place of row numbers.
+
+        :param source: Array; new source labels, in the same order; optional.
+        :param target: Array; new target labels, in the same order; optional.
+        :return: Crosswalk.
+        """
+        return Crosswalk(
+            self.matrix,
+            self.source if source is None else source,
+            self.target if target is None else target
+        )
+
+    def restrict(self, source):
+        """
+        Returns the rows of the crosswalk for the provided source units. Source
+        units which aren't in the crosswalk are skipped.
+
+        :param source: Index; labels of the source units.
+        :return: Crosswalk.
+        """
+        positions = self.source.get_indexer(pd.Index(source))
+        positions = positions[positions >= 0]
+
+        return Crosswalk(self.matrix[positions], self.source[positions], self.target)
+
+    def replace(self, other, target):
+        """
+        Replaces rows of the crosswalk with the rows of another crosswalk, e.g.
+        one for the source units which have to be assigned again after some
+        target units change. Source units only in the other crosswalk are
+        added, and entries for target units which no longer exist are dropped.
+
+        :param other: Crosswalk; new rows.
+        :param target: Index; labels of the target units.
+        :return: Crosswalk.
+        """
+        kept = np.flatnonzero(~self.source.isin(other.source))
+        mine, theirs = self.matrix[kept].tocoo(), other.matrix.tocoo()
+
+        sources = np.concatenate([self.source[kept][mine.row], other.source[theirs.row]])
+        targets = np.concatenate([self.target[mine.col], other.target[theirs.col]])
+        weights = np.concatenate([mine.data, theirs.data])
+
+        target = pd.Index(target)
+        present = target.get_indexer(targets) >= 0
+
+        return Crosswalk.fromweights(
+            sources[present], targets[present], weights[present],
+            self.source[kept].append(other.source), target
+        )
+
+    def values(self, df, columns, index):
+        """
+        Returns the provided columns as a matrix ordered like the provided
+        index, with missing values treated as 0. Columns which are all 32-bit
+        floats stay 32-bit.
+
+        :param df: Dataframe.
+        :param columns: List; columns to return.
+        :param index: Index; order of the rows.
+        :return: NumPy array.
+        """
+        data = df[columns].reindex(index)
+        single = all(data[column].dtype == "float32" for column in columns)
+        return data.to_numpy(dtype="float32" if single else "float64", na_value=0)
+
+    def aggregate(self, df, columns):
+        """
+        Sums source-level data up to the target units.
+
+        :param df: Dataframe indexed like the source units.
+        :param columns: List; columns to aggregate.
+        :return: Dataframe indexed like the target units.
+        """
+        summed = self.matrix.T @ self.values(df, columns, self.source)
+        aggregated = pd.DataFrame(summed, index=self.target, columns=columns)
+
+        # When sources aren't split, integer columns stay integers.
+        if (self.matrix.data == 1).all():
+            for column in columns:
+                if pd.api.types.is_integer_dtype(df[column]):
+                    aggregated[column] = aggregated[column].round().astype(df[column].dtype)
+
+        return aggregated
+
+    def disaggregate(self, df, columns, weights):
+        """
+        Distributes target-level data down to the source units: each source
+        unit gets its target units' values, scaled by its weight.
+
+        :param df: Dataframe indexed like the target units.
+        :param columns: List; columns to disaggregate.
+        :param weights: Series; the share of each target unit's data each source
+            unit receives, indexed like the source units.
+        :return: Dataframe indexed like the source units.
+        """
+        spread = self.matrix @ self.values(df, columns, self.target)
+        scale = weights.reindex(self.source).to_numpy(dtype="float64")
+
+        return pd.DataFrame(spread * scale[:, None], index=self.source, columns=columns)
+
+    def save(self, location):
+        """
+        Writes the crosswalk to a compressed NumPy file. The crosswalk is
+        written to a temporary file and moved into place, so a concurrent
+        reader never sees a truncated file.
+
+        :param location: String; file to write, ending in ".npz".
+        """
+        labels = lambda index: (
+            index.to_numpy(dtype="int64") if pd.api.types.is_integer_dtype(index)
+            else index.astype(str).to_numpy(dtype=str)
+        )
+
+        temporary = f"{location}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            np.savez_compressed(
+                f,
+                data=self.matrix.data,
+                indices=self.matrix.indices,
+                indptr=self.matrix.indptr,
+                shape=self.matrix.shape,
+                source=labels(self.source),
+                target=labels(self.target)
+            )
+        os.replace(temporary, location)
+
+    @classmethod
+    def load(cls, location):
+        """
+        Reads a crosswalk written by `save`.
+
+        :param location: String; file to read.
+        :return: Crosswalk.
+        """
+        with np.load(location) as f:
+            matrix = sparse.csr_matrix(
+                (f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"])
+            )
+            return cls(matrix, f["source"], f["target"])
@@ -0,0 +1,292 @@
+
+import json
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
+from enum import Enum
+
+
+class linenumber(Enum):
+    """
+    Maps names of columns to their positions in each transposed row.
+    """
+    _TOTAL = 0
+    NHCVAP = 1
+    AICVAP = 2
+    ASIANCVAP = 3
+    BCVAP = 4
+    NHPICVAP = 5
+    WCVAP = 6
+    AIWCVAP = 7
+    ASIANWCVAP = 8
+    BWCVAP = 9
+    AIBCVAP = 10
+    OCVAP = 11
+    HISPCVAP = 12
+
+
+# Set a list of line descriptions for the codebook.
+descriptions = [
+    "Total CVAP",
+    "American Indian or Alaska Native Alone",
+    "Asian Alone",
+    "Black or African American Alone",
+    "Native Hawaiian or Other Pacific Islander Alone",
+    "White Alone",
+    "American Indian or Alaska Native and White",
+    "Asian and White",
+    "Black or African American and White",
+    "American Indian or Alaska Native and Black or African American",
+    "Remainder of Two or More Race Responses",
+    "Hispanic or Latino"
+]
+
+
+def lines(year):
+    """
+    Returns the transposed CVAP column names for the provided year. Columns are
+    named "<ACS line number>_<year>"; line 2 (not Hispanic or Latino) is
+    dropped.
+
+    :param year: Integer; year of the CVAP special tabulation.
+    :return: List of column names.
+    """
+    return [f"1_{year}"] + [f"{line}_{year}" for line in range(3, 14)]
+
+
+def codebook(year):
+    """
+    Maps the transposed CVAP column names for the provided year to their
+    descriptions.
+
+    :param year: Integer; year of the CVAP special tabulation.
+    :return: Dictionary of column names to descriptions.
+    """
+    return {col: desc for col, desc in zip(lines(year), descriptions)}
+
+
+def transpose(cvaps, year, value="cvap_est"):
+    """
+    Transposes the ACS CVAP special tabulation so that rows correspond to block
+    groups and columns correspond to racial/ethnic categories. Each block group
+    must be reported on exactly 13 lines, numbered 1 through 13; if the sum of
+    the racial/ethnic categories disagrees with the reported total (and isn't
+    zero), the total is replaced by that sum.
+
+    :param cvaps: Dataframe; CVAP rows with lowercase "geoid", "lnnumber", and
+        value columns.
+    :param year: Integer; year of the CVAP special tabulation.
+    :param value: String; column holding the estimates.
+    :return: Dataframe with a "geoid" column and one column per category.
+    """
+    # Make sure every block group has exactly one of each of the 13 lines
+    # rather than assuming that the rows come in order.
+    counts = cvaps.groupby("geoid", sort=False)["lnnumber"].agg(["size", "nunique"])
+    malformed = counts[(counts["size"] != 13) | (counts["nunique"] != 13)]
+    unnumbered = ~cvaps["lnnumber"].isin(range(1, 14))
+
+    if len(malformed) > 0 or unnumbered.any():
+        bad = list(malformed.index) + list(cvaps.loc[unnumbered, "geoid"].unique())
+        raise ValueError(
+            f"Expected 13 CVAP lines (numbered 1 through 13) for each block "
+            f"group, but {len(set(bad))} block groups don't match, e.g. "
+            f"{sorted(set(bad))[:5]}."
+        )
+
+    # Pivot so each block group is a row and each line number is a column.
+    wide = cvaps.pivot(index="geoid", columns="lnnumber", values=value)
+    wide = wide.reindex(columns=range(1, 14))
+    values = wide.to_numpy()
+
+    # Apply the normalization rule to every block group at once: if the sum of
+    # the categories differs from the reported total and isn't 0, use the sum.
+    parts = values[:, linenumber.AICVAP.value:]
+    _TOTAL = values[:, linenumber._TOTAL.value]
+    _total = parts.sum(axis=1)
+    total = np.where((_total != _TOTAL) & (_total != 0), _total, _TOTAL)
+
+    cvapst = pd.DataFrame(
+        np.column_stack([total, parts]), columns=lines(year)
+    )
+    cvapst.insert(0, "geoid", wide.index.str.split("15000US").str[1])
+
+    return cvapst
+
+
+def source(root, year):
+    """
+    Finds the national CVAP block group file for the provided year: either the
+    `acs-cvap-<year>.zip` archive as downloaded from the Census, or its
+    unzipped `acs-cvap-<year>/BlockGr.csv`.
+
+    :param root: String; directory containing the CVAP files.
+    :param year: Integer; year of the CVAP special tabulation.
+    :return: Tuple of the file's location and, if it's an archive, the name of
+        the block group file inside it.
+    """
+    archive = os.path.join(root, f"acs-cvap-{year}.zip")
+    if os.path.exists(archive):
+        with zipfile.ZipFile(archive) as z:
+            for name in z.namelist():
+                if os.path.basename(name).lower() == "blockgr.csv":
+                    return archive, name
+
+        raise ValueError(f"{archive} doesn't contain a BlockGr.csv file.")
+
+    return os.path.join(root, f"acs-cvap-{year}", "BlockGr.csv"), None
+
+
+@contextmanager
+def lock(location, wait=1):
+    """
+    Holds an exclusive lock, by creating a lock file, while the block runs.
+    Other processes wait until it's released. A lock left behind by a process
+    which no longer exists is taken over.
+
+    :param location: String; location of the lock file.
+    :param wait: Float; seconds between attempts to take the lock; optional.
+    """
+    while True:
+        try:
+            descriptor = os.open(location, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                with open(location) as f: holder = int(f.read() or 0)
+                age = time.time() - os.path.getmtime(location)
+            except (OSError, ValueError):
+                holder, age = 0, 0
+
+            # The holder may not have written its process ID yet, but it won't
+            # take a minute to.
+            if (holder and not alive(holder)) or (not holder and age > 60):
+                try: os.remove(location)
+                except FileNotFoundError: pass
+                continue
+
+            time.sleep(wait)
+
+    try:
+        os.write(descriptor, str(os.getpid()).encode())
+        os.close(descriptor)
+        yield
+    finally:
+        os.remove(location)
+
+
+def alive(pid):
+    """
+    Checks whether a process exists.
+
+    :param pid: Integer; process ID.
+    :return: Boolean.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def partition(root, year, columns=["geoid", "lnnumber", "cvap_est"], chunksize=500000):
+    """
+    Splits the national CVAP block group file for the provided year into one
+    Parquet file per state, in `acs-cvap-<year>-states/`. The
+    national file is streamed (straight out of its archive, if it's zipped) in
+    chunks, and only the provided columns are kept, so it's never loaded all at
+    once. The partitions are rebuilt if the national file changes. Only one
+    process partitions a year at a time; others (e.g. other states' runs, in
+    batch mode) wait for it and use its partitions.
+
+    :param root: String; directory containing the CVAP files.
+    :param year: Integer; year of the CVAP special tabulation.
+    :param columns: List; lowercase names of the columns to keep; optional.
+    :param chunksize: Integer; number of rows read at once; optional.
+    :return: String; directory of partitions.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    location, member = source(root, year)
+    stat = os.stat(location)
+    stamp = {"source": os.path.basename(location), "size": stat.st_size, "mtime": stat.st_mtime}
+
+    destination = os.path.join(root, f"acs-cvap-{year}-states")
+    manifest = os.path.join(destination, "source.json")
+
+    def current():
+        if not os.path.exists(manifest): return False
+        with open(manifest) as f: return json.load(f) == stamp
+
+    if current(): return destination
+
+    with lock(os.path.join(root, f".acs-cvap-{year}.lock")):
+        # Another process may have finished the partitions while we waited.
+        if current(): return destination
+
+        # Write partitions to a temporary directory and move it into place
+        # when it's complete, so an interrupted run never leaves partial
+        # partitions behind.
+        scratch = tempfile.mkdtemp(dir=root, prefix=f".acs-cvap-{year}-")
+        writers = {}
+
+        try:
+            with zipfile.ZipFile(location) if member else open(location, "rb") as handle, \
+                    handle.open(member) if member else handle as stream:
+                chunks = pd.read_csv(
+                    stream, encoding="ISO-8859-1", chunksize=chunksize,
+                    usecols=lambda column: column.lower() in columns
+                )
+
+                for chunk in chunks:
+                    chunk.columns = chunk.columns.str.lower()
+
+                    # GEOIDs look like 15000USsscccttttttb, where ss is the state.
+                    states = chunk["geoid"].str[7:9]
+                    for state, rows in chunk.groupby(states, sort=False):
+                        table = pa.Table.from_pandas(rows[columns], preserve_index=False)
+                        if state not in writers:
+                            writers[state] = pq.ParquetWriter(os.path.join(scratch, f"{state}.parquet"), table.schema)
+                        writers[state].write_table(table)
+
+            for writer in writers.values(): writer.close()
+            with open(os.path.join(scratch, "source.json"), "w") as f: json.dump(stamp, f)
+
+            # Partitions of an older national file are replaced; nothing else
+            # reads them, as they no longer match it.
+            if os.path.exists(destination): shutil.rmtree(destination)
+            os.rename(scratch, destination)
+        finally:
+            for writer in writers.values(): writer.close()
+            if os.path.exists(scratch): shutil.rmtree(scratch)
+
+    return destination
+
+
+def load(root, year, fips, chunksize=500000):
+    """
+    Reads a single state's rows of the national CVAP block group file,
+    partitioning the national file by state first if it hasn't been already.
+
+    :param root: String; directory containing the CVAP files.
+    :param year: Integer; year of the CVAP special tabulation.
+    :param fips: Integer or string; state FIPS code.
+    :param chunksize: Integer; number of rows read at once when partitioning;
+        optional.
+    :return: Dataframe with "geoid", "lnnumber", and "cvap_est" columns.
+    """
+    destination = partition(root, year, chunksize=chunksize)
+    location = os.path.join(destination, f"{str(fips).zfill(2)}.parquet")
+
+    if not os.path.exists(location):
+        raise ValueError(f"The {year} CVAP special tabulation has no block groups in state {fips}.")
+
+    return pd.read_parquet(location)
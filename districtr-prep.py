@@ -1,25 +1,51 @@
 
-import geopandas as gpd
 import pandas as pd
 import os
 import os.path as path
 from shutil import rmtree
 
+from geometry import read, write, filepath, topology
+from config import settings
+
 
 """
-Creates a file with helpful descriptions and a copy of the desired shapefile. To
-be added to the shapes/ directory of the districtr-process repo.
+Creates a file with helpful descriptions and a copy of the desired shapefile
+and/or a simplified TopoJSON file. To be added to the shapes/ directory of the
+districtr-process repo.
 """
 
-georoot = "./data/geometries/"
-exist = "wisconsin-wards-2020-acs-adjoined"
-out = "./data/out/"
+georoot = settings.get("georoot", "./data/geometries/")
+exist = settings.get("aggregated", "wisconsin-wards-2020-acs-adjoined")
+out = settings.get("out", "./data/out/")
+
+# Format of the aggregated file: "parquet", "feather", or "shp". The copy we
+# hand off is always a shapefile.
+fmt = settings.get("fmt", "parquet")
+
+# Which files do we hand off? "shp" is a full-resolution copy of the shapefile;
+# "topojson" is a simplified, quantized TopoJSON file, which is much smaller and
+# faster to load in the browser. TopoJSON requires the topojson package.
+exports = settings.get("exports", ["shp"])
+
+# How much do we simplify and quantize the TopoJSON file? The tolerance is in
+# degrees of longitude and latitude (0.0001 degrees is roughly 10 meters), and
+# the quantization is the number of grid cells along each axis. Set either to
+# None to skip it.
+tolerance = settings.get("tolerance", 0.0001)
+quantization = settings.get("quantization", 100000)
+
+# Which columns do we hand off? If this names a describe CSV (like the one this
+# script writes, with unwanted rows removed), only the columns it lists are
+# written; otherwise, every column is.
+describe = settings.get("describe", None)
+keep = list(pd.read_csv(describe)["name"]) if describe else None
 
 # Clean out the out directory.
-if path.exists(out): rmtree(out); os.mkdir(out)
+if path.exists(out): rmtree(out)
+os.makedirs(out)
 
 # Read in existing geographic data.
-existing = gpd.read_file(path.join(georoot, exist))
+existing = read(filepath(georoot, exist, fmt), columns=keep)
 
 # Create a CSV where the first column is the column name and the second is its
 # dtype.
@@ -31,4 +57,9 @@ pd.DataFrame.from_dict({
 }).to_csv(path.join(out, f"districtr-describe-{exist}.csv"), index=False)
 
 # Create a copy of the shapefile.
-existing.to_file(path.join(out, exist))
+if "shp" in exports:
+	write(existing, path.join(out, exist))
+
+# Create a TopoJSON file, in longitude and latitude.
+if "topojson" in exports:
+	topology(existing.to_crs("EPSG:4326"), path.join(out, f"{exist}.topojson"), tolerance, quantization)
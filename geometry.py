@@ -1,105 +1,978 @@
 
 import geopandas as gpd
-import censusdata
+import numpy as np
+import pandas as pd
 import maup
+import hashlib
+import json
+import os
+import shapely
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_all_start_methods, get_context
+from os import path
+from shutil import rmtree
 
+from crosswalk import Crosswalk
+from instrument import phase
+from pipeline import digest
 
-def dissolve(source, join="CONGDIST", columns=[]):
+
+def workers(processes=None, **kwargs):
+    """
+    Starts a pool of worker processes. The stage scripts run at the top level,
+    without a main guard, so workers started by spawning a fresh interpreter
+    (the default on macOS and Windows, and forkserver's on Linux from Python
+    3.14) would re-run the script; workers are forked wherever that's possible.
+
+    :param processes: Integer; number of worker processes. Defaults to the
+        number of processors; optional.
+    :param kwargs: Passed to `ProcessPoolExecutor`, e.g. an initializer.
+    :return: ProcessPoolExecutor.
+    """
+    context = get_context("fork") if "fork" in get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers=processes, mp_context=context, **kwargs)
+
+
+def assign(source, target, by=None, drop=None, fallback=True, verify=False):
+    """
+    Assigns source geometries to the target geometries containing them. When
+    `by` is provided, units are matched on nested identifiers (e.g. Census
+    GEOIDs, where a block's GEOID begins with its block group's GEOID) rather
+    than spatially: source identifiers are truncated to the length of the
+    target identifiers and joined. Otherwise, falls back to `maup.assign`.
+
+    :param source: Source geometries.
+    :param target: Target geometries.
+    :param by: Tuple; source and target identifier columns. If the target
+        column is None, the target's index is used; optional.
+    :param drop: Integer; number of trailing digits to drop from source
+        identifiers. Inferred from identifier lengths if not provided; optional.
+    :param fallback: Boolean; spatially assign source geometries whose
+        identifiers don't match any target identifier; optional.
+    :param verify: Boolean; compare the identifier-based assignment against a
+        full spatial assignment and report mismatches; optional.
+    :return: Series mapping source indices to target indices.
+    """
+    if by is None:
+        with phase("assign (spatial)", rows=len(source)):
+            return maup.assign(source, target)
+
+    sourcecol, targetcol = by
+    sourcekeys = source[sourcecol]
+    targetkeys = target.index.to_series() if targetcol is None else target[targetcol]
+
+    with phase("assign (identifier)", rows=len(source)):
+        # Identifiers may be stored as integers (losing leading zeros) or
+        # strings; either way, they nest by dropping trailing digits.
+        if drop is None:
+            drop = sourcekeys.astype(str).str.len().max() - targetkeys.astype(str).str.len().max()
+
+        if pd.api.types.is_integer_dtype(sourcekeys):
+            truncated = sourcekeys // 10**drop
+            targetkeys = targetkeys.astype(sourcekeys.dtype)
+        else:
+            truncated = sourcekeys.astype(str)
+            truncated = truncated.str[:-drop] if drop > 0 else truncated
+            targetkeys = targetkeys.astype(str)
+
+        lookup = pd.Series(target.index, index=targetkeys.values)
+        assignment = truncated.map(lookup)
+
+    # Spatially assign whatever didn't match.
+    unmatched = assignment.isna()
+    if fallback and unmatched.any():
+        with phase("assign (fallback)", rows=int(unmatched.sum())):
+            assignment[unmatched] = maup.assign(source[unmatched], target)
+
+    if verify:
+        with phase("assign (verify)", rows=len(source)):
+            spatial = maup.assign(source, target)
+        mismatched = (assignment != spatial) & ~(assignment.isna() & spatial.isna())
+        print(
+            f"{mismatched.sum()} of {len(source)} source geometries were "
+            f"assigned differently by identifier than spatially."
+        )
+
+    if not assignment.isna().any():
+        assignment = assignment.astype(target.index.dtype)
+
+    return assignment
+
+
+def unions(groups):
+    """
+    Unions each of a list of arrays of geometries.
+
+    :param groups: List of arrays of geometries.
+    :return: List of geometries.
+    """
+    return [shapely.union_all(group) for group in groups]
+
+
+def dissolve(source, join="CONGDIST", columns=[], geometry=True, processes=None, chunksize=50000):
     """
     Dissolves source geography boundaries based on a column which identifies
-    the smaller geography with the larger one.
+    the smaller geography with the larger one. Since the column says which
+    larger geography each source belongs to, data are summed by it directly,
+    without a spatial join; the geometries of each larger geography are
+    unioned in parallel.
 
     :param source: String or geodataframe; string is a filepath, geodataframe is source.
     :param join: String; column on which boundaries are joined; optional.
     :param columns: List; columns to sum when dissolving; optional.
-    :return: Geodataframe with dissolved boundaries.
+    :param geometry: Boolean; union geometries. If False, only the summed
+        columns are returned; optional.
+    :param processes: Integer; number of worker processes used to union
+        geometries. Defaults to the number of processors; optional.
+    :param chunksize: Integer; approximate number of source geometries unioned
+        per chunk; optional.
+    :return: Geodataframe with dissolved boundaries, indexed by `join`, or a
+        dataframe if `geometry` is False.
     """
-    # Dissolve VTD geometries into congressional district ones.
-    source = gpd.read_file(source) if type(source) == str else source
-    target = source[[join, "geometry"]].dissolve(by=join)
+    source = read(source) if type(source) == str else source
+
+    # Sources without a join value don't belong to any larger geography.
+    codes, keys = pd.factorize(source[join], sort=True)
+    keys = pd.Index(keys, name=join)
 
     # If columns are specified, we aggregate data from VTDs to whatever the
-    # target is. If a file destination is provided, send the output to a
-    # shapefile.
-    if len(columns) > 0:
-        assignment = maup.assign(source, target)
-        target[columns] = source[columns].groupby(assignment).sum()
+    # target is.
+    with phase("dissolve (sum)", rows=len(source)):
+        target = source[list(columns)].groupby(codes).sum().reindex(range(len(keys)))
+        target.index = keys
 
-    return target
+    if not geometry:
+        return target
+
+    with phase("dissolve (union)", rows=len(source)):
+        # Group the geometries by their join values, then batch the groups so
+        # each chunk unions roughly the same number of geometries.
+        order = np.argsort(codes, kind="stable")
+        order = order[codes[order] >= 0]
+        bounds = np.searchsorted(codes[order], np.arange(len(keys) + 1))
+        geometries = np.asarray(source.geometry.values)[order]
+        groups = [geometries[bounds[i]:bounds[i+1]] for i in range(len(keys))]
+
+        breaks = np.searchsorted(bounds, np.arange(0, bounds[-1], chunksize), side="right") - 1
+        breaks = list(np.unique(np.append(breaks, len(keys))))
+        chunks = [groups[a:b] for a, b in zip(breaks, breaks[1:])]
 
+        if len(chunks) > 1 and processes != 1:
+            with workers(processes) as pool:
+                unioned = [g for chunk in pool.map(unions, chunks) for g in chunk]
+        else:
+            unioned = [g for chunk in chunks for g in unions(chunk)]
 
-def prorate(target, source, targetcol, sourcecol, columns):
+    return gpd.GeoDataFrame(target, geometry=gpd.GeoSeries(unioned, index=keys, crs=source.crs))
+
+
+def downcast(df, columns=None, keys=["GEOID"]):
     """
-    Prorates data the source geometries down to the target geometries.
+    Stores numeric columns in 32-bit dtypes to save memory, and identifier
+    columns as compact keys: identifiers made up only of digits are stored as
+    integers, and other identifiers as categoricals. Integer columns whose values
+    don't fit in 32 bits are left alone.
+
+    :param df: (Geo)dataframe.
+    :param columns: List; numeric columns to downcast. If not provided, every
+        numeric column other than the keys is downcast; optional.
+    :param keys: List; identifier columns to compact; optional.
+    :return: (Geo)dataframe with downcast columns.
+    """
+    keys = [key for key in keys if key in list(df)]
+    if columns is None:
+        columns = [
+            c for c in list(df)
+            if c not in keys and pd.api.types.is_numeric_dtype(df[c])
+            and not pd.api.types.is_bool_dtype(df[c])
+        ]
+
+    for column in columns:
+        if pd.api.types.is_float_dtype(df[column]):
+            df[column] = df[column].astype("float32")
+        elif pd.api.types.is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast="integer")
+            if df[column].dtype.itemsize < 4: df[column] = df[column].astype("int32")
+
+    for key in keys:
+        if pd.api.types.is_object_dtype(df[key]) or pd.api.types.is_string_dtype(df[key]):
+            digits = df[key].astype(str).str.isdigit().all()
+            df[key] = df[key].astype("int64") if digits else df[key].astype("category")
+
+    return df
+
+
+def upcast(df, columns=None):
+    """
+    Restores 32-bit numeric columns to 64 bits, e.g. before writing downcast
+    data to file.
+
+    :param df: (Geo)dataframe.
+    :param columns: List; columns to restore. If not provided, every 32-bit
+        numeric column is restored; optional.
+    :return: (Geo)dataframe with 64-bit columns.
+    """
+    columns = list(df) if columns is None else columns
+
+    for column in columns:
+        if df[column].dtype == "float32":
+            df[column] = df[column].astype("float64")
+        elif pd.api.types.is_integer_dtype(df[column]) and df[column].dtype.itemsize < 8:
+            df[column] = df[column].astype("int64")
+
+    return df
+
+
+def intersections(sources, targets):
+    """
+    Returns the areas of the pairwise intersections of two arrays of geometries.
+
+    :param sources: Array of geometries.
+    :param targets: Array of geometries.
+    :return: Array of areas.
+    """
+    return shapely.area(shapely.intersection(sources, targets))
+
+
+def fractional(source, target, processes=None, chunksize=50000):
+    """
+    Creates a crosswalk which splits source geometries among the target
+    geometries they overlap, in proportion to area. Candidate pairs are found
+    with the target's spatial index; source geometries lying entirely within a
+    single target are assigned to it wholesale, and intersections are only
+    computed for source geometries crossing a target boundary. Intersections
+    are computed in chunks, in parallel.
 
-    :param target: Target geometries.
     :param source: Source geometries.
-    :param targetcol: Column for target weights.
-    :param sourcecol: Column for source weights.
-    :param columns: Columns to prorate.
-    :return: Geodataframe with prorated data.
+    :param target: Target geometries.
+    :param processes: Integer; number of worker processes used to compute
+        intersections. Defaults to the number of processors; optional.
+    :param chunksize: Integer; number of source/target pairs per chunk;
+        optional.
+    :return: Crosswalk from the source geometries to the target geometries.
     """
-    assignment = maup.assign(target, source)
-    weights = target[targetcol] / assignment.map(source[sourcecol])
-    prorated = maup.prorate(assignment, source[columns], weights)
-    target[columns] = prorated
+    sources = source.geometry.values
+    targets = target.geometry.values
 
-    return target
+    # Source geometries entirely within a target take the fast path.
+    with phase("fractional (within)", rows=len(source)):
+        inner, outer = target.sindex.query(sources, predicate="within")
+        inner, first = np.unique(inner, return_index=True)
+        outer = outer[first]
+
+    # Everything else is split among the targets it intersects.
+    with phase("fractional (intersect)", rows=len(source)) as record:
+        rows, cols = target.sindex.query(sources, predicate="intersects")
+        crossing = ~np.isin(rows, inner)
+        rows, cols = rows[crossing], cols[crossing]
+        record["rows"] = len(rows)
+
+        chunks = [
+            (sources[rows[i:i+chunksize]], targets[cols[i:i+chunksize]])
+            for i in range(0, len(rows), chunksize)
+        ]
+
+        if len(chunks) > 1 and processes != 1:
+            with workers(processes) as pool:
+                areas = list(pool.map(intersections, *zip(*chunks)))
+        else:
+            areas = [intersections(s, t) for s, t in chunks]
 
+        areas = np.concatenate(areas) if areas else np.zeros(0)
+        weights = areas / shapely.area(sources[rows])
 
-def retrieve(
-        fips,
-        year,
-        dataset="acs5",
-        geometry=[],
-        cols=["B01001_001E", "GEO_ID"]
-    ):
-    """
-    Retrieves data from the census API.
-
-    :param fips: Integer; state FIPS houston from which we retrieve data.
-    :param year: Integer; year for which we retrieve data.
-    :param dataset: String; Census dataset from which we retrieve data.
-    :param geometry: String; geometry for which we retrieve data.
-    :param cols: List; columns of data to retrieve.
-    :return: Properly-formatted dataframe.
-    """
-    return censusdata.download(
-        dataset,
-        year,
-        censusdata.censusgeo(
-            [("state", str(fips))] + geometry
-        ),
-        cols
+        # Degenerate source geometries (those without area) go to the first
+        # target they touch.
+        degenerate = ~np.isfinite(weights)
+        if degenerate.any():
+            weights[degenerate] = 0
+            _, first = np.unique(rows[degenerate], return_index=True)
+            weights[np.flatnonzero(degenerate)[first]] = 1
+
+        keep = weights > 0
+
+    return Crosswalk.fromweights(
+        np.concatenate([source.index[inner], source.index[rows[keep]]]),
+        np.concatenate([target.index[outer], target.index[cols[keep]]]),
+        np.concatenate([np.ones(len(inner)), weights[keep]]),
+        source.index,
+        target.index
     )
 
 
-def reformat(df, geo=("GEO_ID", "GEOID"), colmap={"B01001_001E": "TOTPOP"}):
+def mend(geometries):
     """
-    Reformats census api data into a more familiar format.
+    Repairs an array of invalid geometries by buffering them by 0.
 
-    :param df: Dataframe.
-    :param geo: Tuple; header to replace, and replacement header.
-    :param colmap: Dictionary; maps old header names to new ones.
-    :return: Modified dataframe.
+    :param geometries: Array of geometries.
+    :return: Array of repaired geometries.
     """
-    # Properly format all the geoids so they don't have that annoying tag on the
-    # front.
-    geo_source, geo_target = geo
-    df[geo_target] = df[geo_source].apply(lambda g: int(g.split("US")[1]))
+    return shapely.buffer(geometries, 0)
 
-    # Set the index to be the "GEOID" column, but immediately reset the index
-    # so we just get the index to be {1, ..., n}.
-    df = df.set_index(geo_target)
-    df = df.reset_index()
 
-    # Delete old column.
-    del df[geo_source]
+def repair(geometries, name="geometries", processes=None, chunksize=1000):
+    """
+    Finds invalid geometries and repairs only those, in place, leaving valid
+    geometries untouched. Repairs are made in chunks, in parallel, and the
+    number of geometries repaired (and the area that changed) is reported.
 
-    # Rename the column(s) appropriately.
-    df = df.rename(columns=colmap)
+    :param geometries: Geodataframe.
+    :param name: String; name of the geometries, used in reports; optional.
+    :param processes: Integer; number of worker processes. Defaults to the
+        number of processors; optional.
+    :param chunksize: Integer; number of geometries per chunk; optional.
+    :return: Geodataframe with repaired geometries.
+    """
+    with phase(f"repair {name}", rows=len(geometries)) as record:
+        values = geometries.geometry.values
+        invalid = np.flatnonzero(~shapely.is_valid(values) & ~shapely.is_missing(values))
+        record["repaired"] = len(invalid)
+        if len(invalid) == 0: return geometries
 
-    return df
+        broken = np.asarray(values[invalid])
+        chunks = [broken[i:i+chunksize] for i in range(0, len(broken), chunksize)]
+
+        if len(chunks) > 1 and processes != 1:
+            with workers(processes) as pool:
+                mended = np.concatenate(list(pool.map(mend, chunks)))
+        else:
+            mended = np.concatenate([mend(chunk) for chunk in chunks])
+
+        record["areachange"] = float(np.abs(shapely.area(mended) - shapely.area(broken)).sum())
+        column = geometries.geometry.name
+        geometries.iloc[invalid, geometries.columns.get_loc(column)] = mended
+
+    print(
+        f"Repaired {len(invalid)} of {len(geometries)} {name}, changing their "
+        f"total area by {record['areachange']:.6g}."
+    )
+
+    return geometries
+
+
+# Lengths of Census GEOIDs for states, counties, tracts, block groups, and
+# blocks. GEOIDs stored as integers lose their leading zeros, so we use these to
+# recover their lengths.
+widths = [2, 5, 11, 12, 15]
+
+
+def width(keys):
+    """
+    Returns the length of the provided GEOIDs, including leading zeros.
+
+    :param keys: Series; GEOIDs, as integers or strings.
+    :return: Integer; length of the GEOIDs.
+    """
+    longest = keys.astype(str).str.len().max()
+    if not pd.api.types.is_integer_dtype(keys):
+        return longest
+
+    return min([w for w in widths if w >= longest] + [longest])
+
+
+def county(keys, digits=5, length=None):
+    """
+    Truncates GEOIDs to their county GEOIDs (or, given a different number of
+    digits, to any other level of the Census hierarchy).
+
+    :param keys: Series; GEOIDs, as integers or strings.
+    :param digits: Integer; length of the truncated GEOIDs; optional.
+    :param length: Integer; length of the GEOIDs. Inferred if not provided;
+        optional.
+    :return: Series of truncated GEOIDs.
+    """
+    length = length if length else width(keys)
+    if pd.api.types.is_integer_dtype(keys):
+        return keys // 10**(length - digits)
+
+    return keys.astype(str).str[:digits]
+
+
+def tile(location, key, by="GEOID", digits=5, length=15, columns=None):
+    """
+    Reads the geometries in a single county (or other GEOID prefix) from a
+    GeoParquet file, filtering rows as they're read so the rest of the file is
+    never loaded.
+
+    :param location: String; GeoParquet file (or directory of them).
+    :param key: Integer or string; county GEOID.
+    :param by: String; GEOID column; optional.
+    :param digits: Integer; length of the county GEOID; optional.
+    :param length: Integer; length of the GEOIDs in the file; optional.
+    :param columns: List; columns to load. If not provided, every column is
+        loaded; optional.
+    :return: Geodataframe.
+    """
+    if isinstance(key, str):
+        low, high = key, str(int(key) + 1).zfill(digits)
+    else:
+        low, high = key * 10**(length - digits), (key + 1) * 10**(length - digits)
+
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + [by, "geometry"]))
+
+    return gpd.read_parquet(location, columns=columns, filters=[(by, ">=", low), (by, "<", high)])
+
+
+# Geometries shared with every worker process of a tiled job (or of a
+# multi-layer assignment), so they're only sent to each worker once.
+shared = {}
+
+
+def share(other):
+    """
+    Stores geometries shared by every tile in a worker process.
+
+    :param other: Geodataframe.
+    """
+    shared["other"] = other
+
+
+def runtile(source, key, by, digits, length, load, task, kwargs):
+    """
+    Runs a task on a single tile, against the shared geometries which intersect
+    it.
+
+    :return: Tuple of the county GEOID and the task's result.
+    """
+    piece = tile(source, key, by, digits, length, load) if isinstance(source, str) else source
+    other = shared["other"]
+
+    if other.crs and piece.crs and piece.crs != other.crs:
+        piece.to_crs(other.crs, inplace=True)
+
+    nearby = np.sort(other.sindex.query(shapely.box(*piece.total_bounds), predicate="intersects"))
+    return key, task(piece, other.iloc[nearby], **kwargs)
+
+
+def tiled(source, other, task, by="GEOID", digits=5, load=None, processes=None, **kwargs):
+    """
+    Runs a task county-by-county, in parallel. Source geometries (generally
+    blocks) are partitioned by the county their GEOID places them in; each
+    county is run against only the other geometries (block groups, wards, etc.)
+    intersecting it. When the source is a GeoParquet file, each worker reads
+    only its own county, so peak memory depends on the largest county rather
+    than the whole state. Results are yielded as counties finish, and only a
+    few are kept in memory at once.
+
+    :param source: String or geodataframe; GeoParquet file, or source
+        geometries.
+    :param other: Geodataframe; geometries shared by every county.
+    :param task: Function taking a county's source geometries and the nearby
+        other geometries (plus any keyword arguments) and returning a result.
+        Must be importable, e.g. defined in this module.
+    :param by: String; GEOID column of the source geometries; optional.
+    :param digits: Integer; length of the county GEOIDs; optional.
+    :param load: List; columns to read from the GeoParquet file; optional.
+    :param processes: Integer; number of worker processes. Defaults to the
+        number of processors; optional.
+    :param kwargs: Passed to the task.
+    :return: Generator of (county GEOID, result) tuples.
+    """
+    if isinstance(source, str):
+        keys = pd.read_parquet(source, columns=[by])[by]
+        length = width(keys)
+        counties = county(keys, digits, length).unique()
+        del keys
+        jobs = ((source, key) for key in counties)
+    else:
+        length = width(source[by])
+        counties = county(source[by], digits, length)
+        jobs = ((piece, key) for key, piece in source.groupby(counties))
+
+    processes = processes if processes else os.cpu_count()
+
+    with workers(processes, initializer=share, initargs=(other,)) as pool:
+        submit = lambda job: pool.submit(runtile, *job, by, digits, length, load, task, kwargs)
+        pending = {submit(job) for _, job in zip(range(2 * processes), jobs)}
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                job = next(jobs, None)
+                if job is not None: pending.add(submit(job))
+
+
+def aggregatetile(blocks, targets, columns, split=False):
+    """
+    Aggregates a county's blocks up to the nearby targets; used with `tiled`.
+
+    :param blocks: Geodataframe; blocks in the county.
+    :param targets: Geodataframe; targets intersecting the county.
+    :param columns: List; columns to aggregate.
+    :param split: Boolean; split blocks among targets by area; optional.
+    :return: Tuple of the aggregated data, indexed by target, and the sums of
+        the county's block data.
+    """
+    if len(targets) == 0:
+        return pd.DataFrame(columns=columns, dtype=float), blocks[columns].sum()
+
+    if split:
+        crosswalk = fractional(blocks, targets, processes=1)
+    else:
+        crosswalk = Crosswalk.fromassignment(maup.assign(blocks, targets), targets.index)
+
+    return crosswalk.aggregate(blocks, columns), blocks[columns].sum()
+
+
+def crosswalktask(targets, split=False):
+    """
+    Assigns the shared blocks to a layer of targets; used by `crosswalks`.
+
+    :param targets: Geodataframe; targets.
+    :param split: Boolean; split blocks among targets by area; optional.
+    :return: Crosswalk from the blocks to the targets.
+    """
+    blocks = shared["other"]
+    if split:
+        return fractional(blocks, targets, processes=1)
+
+    return Crosswalk.fromassignment(maup.assign(blocks, targets), targets.index)
+
+
+def crosswalks(blocks, layers, split=False, processes=None):
+    """
+    Assigns blocks to several layers of targets (e.g. wards, municipalities,
+    and districts) at once, each layer in its own worker process. Blocks are
+    sent to each worker once, however many layers it assigns them to. A single
+    layer is assigned in this process, with split blocks' intersections
+    computed in parallel instead.
+
+    :param blocks: Geodataframe; blocks.
+    :param layers: List of geodataframes; targets, in the blocks' CRS.
+    :param split: Boolean; split blocks among targets by area; optional.
+    :param processes: Integer; number of worker processes. Defaults to the
+        number of processors; optional.
+    :return: List of crosswalks, one for each layer.
+    """
+    if len(layers) == 1:
+        layer = layers[0]
+        if split:
+            return [fractional(blocks, layer, processes=processes)]
+
+        return [Crosswalk.fromassignment(maup.assign(blocks, layer), layer.index)]
+
+    processes = min(processes if processes else os.cpu_count(), len(layers))
+    with workers(processes, initializer=share, initargs=(blocks,)) as pool:
+        return list(pool.map(crosswalktask, layers, [split] * len(layers)))
+
+
+def proratetile(blocks, bgs, weights, nested=True):
+    """
+    Prorates data from the nearby block groups down to a county's blocks; used
+    with `tiled`.
+
+    :param blocks: Geodataframe; blocks in the county.
+    :param bgs: Geodataframe; block groups intersecting the county.
+    :param weights: List; (weight column, columns to prorate) pairs.
+    :param nested: Boolean; match blocks to block groups by GEOID before
+        assigning them spatially; optional.
+    :return: Geodataframe of prorated blocks.
+    """
+    blocks = repair(blocks, "blocks", processes=1)
+    assignment = assign(blocks, bgs, by=("GEOID", "GEOID") if nested else None)
+    for weight, columns in weights:
+        blocks = prorate(blocks, bgs, weight, weight, columns, assignment=assignment)
+
+    return blocks
+
+
+def fields(location):
+    """
+    Returns the names of the columns in a geometry file without reading it.
+
+    :param location: String; location of the file.
+    :return: List of column names.
+    """
+    if location.endswith(".parquet"):
+        import pyarrow.dataset
+        return pyarrow.dataset.dataset(location).schema.names
+    if location.endswith(".feather"):
+        import pyarrow.feather
+        return pyarrow.feather.read_table(location, memory_map=True).schema.names
+
+    return list(gpd.read_file(location, rows=0))
+
+
+def filepath(root, name, fmt="parquet"):
+    """
+    Returns the location of a geometry file. Shapefiles are stored in
+    directories named for their contents; columnar formats are stored in single
+    files with the appropriate extension.
+
+    :param root: String; directory containing the file.
+    :param name: String; name of the file.
+    :param fmt: String; one of "parquet", "feather", or "shp"; optional.
+    :return: String; location of the file.
+    """
+    return path.join(root, name) if fmt == "shp" else path.join(root, f"{name}.{fmt}")
+
+
+def reproject(mask, crs, segments=256, pad=0.001):
+    """
+    Reprojects geometries used to filter what's read from a file. Only vertices
+    are reprojected, so an edge which is straight in one CRS (like a side of a
+    state-wide bounding box) can bow kilometers inward in another; edges are
+    densified first, and the results padded slightly, so features at the edges
+    of the area aren't missed.
+
+    :param mask: GeoSeries or geodataframe.
+    :param crs: CRS to reproject to.
+    :param segments: Integer; edges are split into pieces no longer than the
+        mask's extent divided by this; optional.
+    :param pad: Float; geometries are padded by this share of the reprojected
+        extent; optional.
+    :return: GeoSeries.
+    """
+    geometries = gpd.GeoSeries(np.asarray(mask.geometry), crs=mask.crs)
+    if geometries.empty or geometries.crs == crs: return geometries.to_crs(crs)
+
+    minx, miny, maxx, maxy = geometries.total_bounds
+    length = max(maxx - minx, maxy - miny) / segments
+    if length > 0: geometries = gpd.GeoSeries(shapely.segmentize(np.asarray(geometries), length), crs=mask.crs)
+    geometries = geometries.to_crs(crs)
+
+    minx, miny, maxx, maxy = geometries.total_bounds
+    distance = max(maxx - minx, maxy - miny) * pad
+    if distance > 0: geometries = gpd.GeoSeries(shapely.buffer(np.asarray(geometries), distance, join_style="mitre"), crs=crs)
+
+    return geometries
+
+
+def region(bbox=None, mask=None, crs=None):
+    """
+    Combines a bounding box and a mask into a single geometry.
+
+    :param bbox: Tuple; (minx, miny, maxx, maxy) bounding box, in the
+        coordinates of the file being read; optional.
+    :param mask: Geometry, GeoSeries, or geodataframe. GeoSeries and
+        geodataframes are reprojected to the provided CRS and unioned; optional.
+    :param crs: CRS of the file being read; optional.
+    :return: Geometry, or None if neither a bounding box nor a mask is provided.
+    """
+    if isinstance(mask, (gpd.GeoSeries, gpd.GeoDataFrame)):
+        if mask.crs and crs: mask = reproject(mask, crs)
+        mask = shapely.union_all(np.asarray(mask.geometry))
+
+    area = shapely.box(*bbox) if bbox is not None else None
+    if mask is not None:
+        area = mask if area is None else shapely.intersection(area, mask)
+
+    return area
+
+
+def scan(location, columns=None, bbox=None, mask=None, batchsize=100000):
+    """
+    Reads the geometries in a GeoParquet or Feather file which intersect a
+    bounding box or mask, a batch of rows at a time, so geometries outside the
+    area are never all held in memory at once.
+
+    :param location: String; location of the file.
+    :param columns: List; columns to load, including the geometry column. If
+        not provided, all columns are loaded; optional.
+    :param bbox: Tuple; bounding box, in the file's coordinates; optional.
+    :param mask: Geometry, GeoSeries, or geodataframe; optional.
+    :param batchsize: Integer; number of rows read at once; optional.
+    :return: Geodataframe.
+    """
+    import pyarrow.dataset
+
+    dataset = pyarrow.dataset.dataset(location, format="parquet" if location.endswith(".parquet") else "ipc")
+    metadata = json.loads(dataset.schema.metadata[b"geo"])
+    column = metadata["primary_column"]
+
+    # GeoParquet files without a CRS are in longitude/latitude.
+    crs = metadata["columns"][column].get("crs", "OGC:CRS84")
+    area = region(bbox, mask, crs)
+    shapely.prepare(area)
+
+    pieces = []
+    for batch in dataset.to_batches(columns=columns, batch_size=batchsize):
+        geometries = shapely.from_wkb(batch.column(column).to_numpy(zero_copy_only=False))
+        keep = shapely.intersects(geometries, area)
+        if not keep.any(): continue
+
+        piece = batch.to_pandas()[keep]
+        piece[column] = geometries[keep]
+        pieces.append(piece)
+
+    names = columns if columns is not None else dataset.schema.names
+    frame = pd.concat(pieces, ignore_index=True) if pieces else pd.DataFrame(columns=names)
+    return gpd.GeoDataFrame(frame, geometry=column, crs=crs)
+
+
+def read(location, columns=None, bbox=None, mask=None, geometry=True):
+    """
+    Reads geometries from a GeoParquet file, a Feather file, or a shapefile (or
+    directory containing one), based on the file extension. Only the requested
+    columns, and only the geometries intersecting the bounding box or mask, are
+    loaded.
+
+    :param location: String; location of the file.
+    :param columns: List; columns to load, in addition to the geometry column.
+        If not provided, all columns are loaded; optional.
+    :param bbox: Tuple; (minx, miny, maxx, maxy) bounding box, in the file's
+        coordinates. If provided, only geometries intersecting it are loaded;
+        optional.
+    :param mask: Geometry, GeoSeries, or geodataframe. If provided, only
+        geometries intersecting it are loaded; GeoSeries and geodataframes are
+        reprojected to match the file; optional.
+    :param geometry: Boolean; load geometries. If False, only the other
+        columns are returned, and columnar formats never read the geometries;
+        optional.
+    :return: Geodataframe, or a dataframe if `geometry` is False.
+    """
+    filtered = bbox is not None or mask is not None
+    if not geometry and not filtered and location.endswith((".parquet", ".feather")):
+        with phase(f"read {path.basename(path.normpath(location))}") as record:
+            reader = pd.read_parquet if location.endswith(".parquet") else pd.read_feather
+            if columns is None: columns = [c for c in fields(location) if c != "geometry"]
+            table = reader(location, columns=[c for c in columns if c != "geometry"])
+            record["rows"] = len(table)
+
+        return table
+
+    if columns is not None:
+        columns = list(columns) + (["geometry"] if "geometry" not in columns else [])
+
+    with phase(f"read {path.basename(path.normpath(location))}") as record:
+        if location.endswith((".parquet", ".feather")) and filtered:
+            geometries = scan(location, columns, bbox, mask)
+        elif location.endswith(".parquet"):
+            geometries = gpd.read_parquet(location, columns=columns)
+        elif location.endswith(".feather"):
+            geometries = gpd.read_feather(location, columns=columns)
+        else:
+            try: import pyogrio
+            except ImportError: pyogrio = None
+
+            # pyogrio skips unwanted columns as it reads, but doesn't support
+            # masks; otherwise, unwanted columns are dropped once read.
+            if pyogrio and mask is None:
+                attributes = None if columns is None else [c for c in columns if c != "geometry"]
+                geometries = gpd.read_file(location, bbox=bbox, engine="pyogrio", columns=attributes)
+            else:
+                geometries = gpd.read_file(location, bbox=bbox, mask=mask)
+                geometries = geometries if columns is None else geometries[columns]
+
+        record["rows"] = len(geometries)
+
+    if not geometry:
+        return pd.DataFrame(geometries.drop(columns=geometries.geometry.name))
+
+    return geometries
+
+
+def readjson(location):
+    """
+    Reads a JSON cache file. Caches which are missing or can't be read (e.g.
+    left truncated by an interrupted run) are treated as empty.
+
+    :param location: String; file to read.
+    :return: Dictionary.
+    """
+    try:
+        with open(location) as f: return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def writejson(data, location):
+    """
+    Writes a JSON cache file. The data are written to a temporary file and
+    moved into place, so concurrent writers and interrupted runs never leave a
+    truncated file behind.
+
+    :param data: Dictionary.
+    :param location: String; file to write.
+    """
+    temporary = f"{location}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, "w") as f: json.dump(data, f)
+    os.replace(temporary, location)
+
+
+def representatives(location, crs, cache="./data/.cache/points/"):
+    """
+    Returns a representative point (a point guaranteed to lie inside the
+    geometry) and the area of every geometry in a file, in the provided CRS.
+    These are cached on disk, keyed by the file's contents and the CRS, so
+    later calls for the same file and CRS skip reading, reprojecting, and
+    processing the geometries entirely.
+
+    :param location: String; location of the file.
+    :param crs: CRS of the points and areas.
+    :param cache: String; directory for cached points; optional.
+    :return: Geodataframe of points with an "area" column, in the same order as
+        the geometries in the file.
+    """
+    # Hashes of files whose size and modification time haven't changed are
+    # reused, so large files aren't read just to find them in the cache.
+    digests = path.join(cache, "digests.json")
+    known = readjson(digests)
+
+    crs = gpd.GeoSeries([], crs=crs).crs
+    key = hashlib.sha256(f"{digest(location, known)}:{crs.to_wkt() if crs else None}".encode()).hexdigest()
+    cached = path.join(cache, f"{key}.parquet")
+
+    os.makedirs(cache, exist_ok=True)
+    writejson(known, digests)
+
+    if path.exists(cached):
+        with phase("read representative points") as record:
+            points = gpd.read_parquet(cached)
+            record["rows"] = len(points)
+
+        return points
+
+    geometries = read(location, columns=[])
+    with phase("reproject geometries", rows=len(geometries)):
+        if crs and geometries.crs and geometries.crs != crs:
+            geometries.to_crs(crs, inplace=True)
+
+    with phase("representative points", rows=len(geometries)):
+        values = geometries.geometry.values
+        points = gpd.GeoDataFrame(
+            {"area": values.area}, geometry=values.representative_point(), crs=geometries.crs
+        )
+
+    # Write to a temporary file and move it into place, so an interrupted
+    # write is never mistaken for a cached result.
+    temporary = f"{cached}.{os.getpid()}"
+    points.to_parquet(temporary, index=False)
+    os.replace(temporary, cached)
+
+    return points
+
+
+def locate(points, target):
+    """
+    Assigns points to the target geometries containing them, with a single
+    query of the targets' spatial index. Points on a boundary go to the first
+    of the targets they touch; points outside every target aren't assigned.
+
+    :param points: Geodataframe of points, e.g. from `representatives`.
+    :param target: Target geometries.
+    :return: Series mapping each point's label to its target's label.
+    """
+    with phase("locate points", rows=len(points)):
+        rows, cols = target.sindex.query(points.geometry.values, predicate="intersects")
+
+        # The index returns matches in tree order, which depends on every
+        # target; sort them, so ties go to the target listed first.
+        order = np.lexsort((cols, rows))
+        rows, cols = rows[order], cols[order]
+        rows, first = np.unique(rows, return_index=True)
+
+        return pd.Series(target.index[cols[first]], index=points.index[rows]).reindex(points.index)
+
+
+def fingerprints(geometries):
+    """
+    Hashes each geometry, so geometries can be matched across versions of a
+    file regardless of their order or attributes. Geometries are normalized
+    first, so the same shape hashes the same however its vertices are ordered;
+    identical geometries are told apart by the order they appear in.
+
+    :param geometries: GeoSeries or geodataframe.
+    :return: Series of hex digests, indexed like the geometries.
+    """
+    with phase("fingerprint geometries", rows=len(geometries)):
+        values = shapely.to_wkb(shapely.normalize(np.asarray(geometries.geometry)))
+        hashes = pd.Series(
+            [hashlib.sha256(value).hexdigest() for value in values], index=geometries.index
+        )
+
+        return hashes + "-" + hashes.groupby(hashes).cumcount().astype(str)
+
+
+def write(geometries, location):
+    """
+    Writes geometries to a GeoParquet file, a Feather file, or a shapefile,
+    based on the file extension. Shapefiles without an extension are written to
+    a directory, which is created if it doesn't exist. Columnar formats are much
+    faster to read and write, don't truncate column names, and have no size
+    limit, so they're preferred for intermediate files.
+
+    :param geometries: Geodataframe.
+    :param location: String; location of the file.
+    """
+    with phase(f"write {path.basename(path.normpath(location))}", rows=len(geometries)):
+        # Columnar files written tile-by-tile are directories; replace them.
+        if location.endswith((".parquet", ".feather")) and path.isdir(location):
+            rmtree(location)
+
+        if location.endswith(".parquet"):
+            geometries.to_parquet(location, index=False)
+        elif location.endswith(".feather"):
+            geometries.to_feather(location, index=False)
+        else:
+            if not location.endswith(".shp") and not path.exists(location):
+                os.makedirs(location)
+            geometries.to_file(location)
+
+
+def topology(geometries, location, tolerance=None, quantization=1e5, name=None):
+    """
+    Writes geometries to a TopoJSON file. Boundaries shared by neighboring
+    geometries are stored once, as shared arcs, and simplified together, so
+    simplification doesn't open gaps or overlaps between neighbors.
+    Coordinates are quantized to a grid and delta-encoded as integers. Requires
+    the `topojson` package.
+
+    :param geometries: Geodataframe.
+    :param location: String; location of the file.
+    :param tolerance: Float; Douglas-Peucker simplification tolerance, in the
+        units of the geometries' CRS. If not provided, geometries aren't
+        simplified; optional.
+    :param quantization: Integer; number of grid cells along each axis of the
+        quantization grid. If not provided, coordinates aren't quantized;
+        optional.
+    :param name: String; name of the TopoJSON object. Defaults to the file's
+        name; optional.
+    """
+    import topojson
+
+    name = name if name else path.splitext(path.basename(location))[0]
+
+    with phase(f"write {path.basename(location)}", rows=len(geometries)):
+        topology = topojson.Topology(
+            geometries,
+            prequantize=quantization if quantization else False,
+            toposimplify=tolerance if tolerance else False,
+            object_name=name
+        )
+        topology.to_json(location)
+
+
+def prorate(target, source, targetcol, sourcecol, columns, assignment=None, by=None):
+    """
+    Prorates data the source geometries down to the target geometries.
+
+    :param target: Target geometries.
+    :param source: Source geometries.
+    :param targetcol: Column for target weights.
+    :param sourcecol: Column for source weights.
+    :param columns: Columns to prorate.
+    :param assignment: Series; precomputed assignment of target geometries to
+        source geometries, e.g. from a previous call to `maup.assign(target,
+        source)`. Computed if not provided; optional.
+    :param by: Tuple; target and source identifier columns passed to `assign`
+        when computing the assignment; optional.
+    :return: Geodataframe with prorated data.
+    """
+    if assignment is None:
+        assignment = assign(target, source, by=by)
+
+    # Every column is prorated at once, by multiplying the source data by a
+    # sparse matrix relating targets to sources.
+    with phase("prorate", rows=len(target)):
+        weights = target[targetcol] / assignment.map(source[sourcecol])
+        crosswalk = Crosswalk.fromassignment(assignment, source.index)
+        target[columns] = crosswalk.disaggregate(source, columns, weights)
+
+    return target
 
 
 def reset_index(df, _from, _to):
@@ -118,27 +991,3 @@ def reset_index(df, _from, _to):
     del df[_from]
 
     return df
-
-
-def variables(prefix, start, stop, suffix="E"):
-    """
-    Returns the ACS variable names from the provided prefix, start, stop, and
-    suffix parameters. Used to generate batches of names, especially for things
-    like voting-age population. Variable names are formatted in the following
-    way:
-
-                    <prefix>_<number identifier><suffix>
-
-    where <prefix> is a population grouping, <number identifier> is the number
-    of the variable in that grouping, and <suffix> designates the file used.
-
-    :param str prefix: Population grouping; typically "B01001".
-    :param int start: Where to start numbering.
-    :param int stop: Where to stop numbering. Inclusive.
-    :param str suffix: Suffix designating the file. For most purposes, this is
-        "E".
-    """
-    return [
-        f"{prefix}_{str(t).zfill(3)}{suffix}"
-        for t in range(start, stop+1)
-    ]
@@ -0,0 +1,182 @@
+
+import atexit
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from os import path
+
+from config import settings
+
+"""
+Records how long each phase of a script takes, how many rows it handles, and how
+much memory the process uses. Scripts and the helpers in `geometry.py` wrap
+their work in phases, e.g.
+
+    with phase("assign blocks", rows=len(blocks)):
+        assignment = maup.assign(blocks, bgs)
+
+When the "reports" parameter names a directory, a JSON report of every phase is
+written there (as `<script>.json`) when the script exits. Each phase records
+the process's resident set size when it starts and ends, and its peak while the
+phase ran; outside Linux, where the peak can't be reset, that's the peak since
+the process started. When the "profile"
+parameter names a phase, that phase is run under cProfile and its statistics
+are dumped alongside the report (as `<script>.<phase>.prof`).
+"""
+
+# Completed phases, and the names of the phases currently running in each
+# thread (phases run in worker threads, e.g. one per year, nest separately).
+phases = []
+local = threading.local()
+started = time.time()
+
+# The highest resident set size seen by each running phase (by the ID of its
+# record), and by the process, before the high-water mark was last reset.
+peaks = {}
+highest = 0
+resetting = threading.Lock()
+
+
+def memory():
+    """
+    Returns the process's current and peak resident set sizes, in bytes. The
+    current size is only available on Linux.
+    """
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS. On Linux,
+    # it's reset along with the high-water mark, so peaks from before the last
+    # reset are kept separately.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = max(peak if sys.platform == "darwin" else peak * 1024, highest)
+
+    try:
+        with open("/proc/self/statm") as f: pages = int(f.read().split()[1])
+        current = pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        current = None
+
+    return current, peak
+
+
+def highwater(reset=False):
+    """
+    Returns the process's peak resident set size, in bytes, since the peak was
+    last reset, optionally resetting it. Only available on Linux.
+
+    :param reset: Boolean; reset the peak to the current size; optional.
+    :return: Integer, or None if not available.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+        if reset:
+            with open("/proc/self/clear_refs", "w") as f: f.write("5")
+    except (OSError, ValueError, StopIteration):
+        return None
+
+    return peak
+
+
+def script():
+    """
+    Returns the name of the running script, without its extension.
+    """
+    name = path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python"
+    return path.splitext(name)[0]
+
+
+@contextmanager
+def phase(name, rows=None):
+    """
+    Times a named phase of work and records its memory use. The record is
+    yielded so the number of rows can be filled in once it's known.
+
+    :param name: String; name of the phase.
+    :param rows: Integer; number of rows processed; optional.
+    :return: Dictionary; record of the phase.
+    """
+    if not hasattr(local, "running"): local.running = []
+    running = local.running
+    record = {"phase": name, "parent": running[-1] if running else None, "rows": rows}
+    running.append(name)
+
+    # Reset the high-water mark, so it tracks this phase, after passing the
+    # peak so far on to the phases already running.
+    global highest
+    record["startrss"], _ = memory()
+    with resetting:
+        peak = highwater(reset=True)
+        highest = max(highest, peak or 0)
+        for key in peaks: peaks[key] = max(peaks[key], peak or 0)
+        peaks[id(record)] = record["startrss"] or 0
+
+    profiler = cProfile.Profile() if settings.get("profile") == name else None
+    start = time.perf_counter()
+    if profiler: profiler.enable()
+
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(location(f"{name.replace(' ', '-')}.prof"))
+
+        seconds = time.perf_counter() - start
+        current, lifetime = memory()
+        with resetting:
+            peak = highwater()
+            peak = lifetime if peak is None else max(peak, peaks[id(record)])
+            del peaks[id(record)]
+
+        record.update({
+            "seconds": seconds,
+            "rowspersecond": record["rows"] / seconds if record["rows"] and seconds > 0 else None,
+            "rss": current,
+            "peakrss": peak
+        })
+
+        running.pop()
+        phases.append(record)
+
+
+def location(suffix):
+    """
+    Returns where report files for this script are written.
+
+    :param suffix: String; file suffix.
+    :return: String; file location.
+    """
+    directory = settings.get("reports") or "."
+    os.makedirs(directory, exist_ok=True)
+    return path.join(directory, f"{script()}.{suffix}")
+
+
+def report(destination=None):
+    """
+    Writes a JSON report of every phase completed so far.
+
+    :param destination: String; file to write. Defaults to `<script>.json` in
+        the reports directory; optional.
+    :return: Dictionary; the report.
+    """
+    _, peak = memory()
+    summary = {
+        "script": script(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+        "seconds": time.time() - started,
+        "peakrss": peak,
+        "phases": phases
+    }
+
+    with open(destination if destination else location("json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+    return summary
+
+
+if settings.get("reports"):
+    atexit.register(report)
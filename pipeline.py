@@ -0,0 +1,450 @@
+
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os import path
+
+"""
+Runs the data preparation scripts as a pipeline. Each stage is fingerprinted by
+the contents of its script (and the helper modules it uses), the parameters it
+reads, and the contents of its input files; a stage is skipped when its
+fingerprint matches the last successful run and its outputs haven't changed
+since. Because inputs are compared by content, a stage whose upstream stage
+reran but produced identical outputs is skipped too.
+
+Parameters are read from a JSON file and passed to each script through the
+PREP_CONFIG environment variable (see `config.py`). For example,
+
+    python pipeline.py config.json
+    python pipeline.py config.json --stages acs-data-retrieve
+    python pipeline.py config.json --force
+    python pipeline.py config.json --states 27 55 --workers 4 --memory 16
+
+Incremental rebuilds rely on stages writing new files rather than overwriting
+their inputs, so `census-data-adjoin` should use a columnar `fmt` when run from
+here.
+"""
+
+# Parameters used when they aren't specified in the config file.
+defaults = {
+    "state": 55,
+    "year": 2019,
+    "georoot": "./data/geometries/",
+    "demoroot": "./data/demographics/",
+    "out": "./data/out/",
+    "fmt": "parquet",
+    "cvap": False,
+    "target": "wisconsin-wards-2020",
+    "aggregated": "wisconsin-wards-2020-acs-adjoined",
+    "manifest": "./data/.pipeline.json"
+}
+
+# Helper modules imported by the scripts; changing them invalidates every stage.
+modules = ["geometry.py", "census.py", "crosswalk.py", "cvap.py", "acs.py", "store.py", "config.py"]
+
+
+def location(root, name, fmt):
+    """
+    Returns the location of a geometry file; mirrors `geometry.filepath`, which
+    we don't import so the runner doesn't pay for loading geopandas.
+    """
+    return path.join(root, name) if fmt == "shp" else path.join(root, f"{name}.{fmt}")
+
+
+# Stages of the pipeline, in the order they're run. Each stage lists the stages
+# it runs after, the parameters it reads, and functions from the parameters to
+# its input and output files.
+stages = {
+    "census-data-adjoin": {
+        "after": [],
+        "parameters": ["state", "georoot", "fmt"],
+        "inputs": lambda c: [path.join(c["georoot"], "bgs"), path.join(c["georoot"], "blocks")],
+        "outputs": lambda c: [
+            location(c["georoot"], "bgs", c["fmt"]),
+            location(c["georoot"], "blocks", c["fmt"])
+        ]
+    },
+    "cvap-data-prep": {
+        "after": ["census-data-adjoin"],
+        "parameters": ["state", "years", "demoroot", "cvaproot"],
+        "inputs": lambda c: [
+            path.join(c["cvaproot"], f"acs-cvap-{year}.zip")
+            if path.exists(path.join(c["cvaproot"], f"acs-cvap-{year}.zip"))
+            else path.join(c["cvaproot"], f"acs-cvap-{year}", "BlockGr.csv")
+            for year in c["years"]
+        ],
+        "outputs": lambda c: [
+            path.join(c["demoroot"], "acs-cvap-transposed", f"bg-cvaps-t-{year}.csv")
+            for year in c["years"]
+        ] + [path.join(c["demoroot"], "cvap-codebook.json")]
+    },
+    "acs-data-retrieve": {
+        "after": ["cvap-data-prep"],
+        "parameters": ["state", "years", "columns", "derived", "georoot", "demoroot"],
+        "inputs": lambda c: [],
+        "outputs": lambda c: [path.join(c["demoroot"], "acs-long.csv")]
+    },
+    "acs-cvap-adjoin-disaggregate": {
+        "after": ["acs-data-retrieve"],
+        "parameters": ["state", "years", "georoot", "demoroot", "fmt", "lean", "tiled", "store"],
+        "inputs": lambda c: [
+            location(c["georoot"], "bgs", c["fmt"]),
+            location(c["georoot"], "blocks", c["fmt"]),
+            path.join(c["demoroot"], "acs-long.csv")
+        ] + [
+            path.join(c["demoroot"], "acs-cvap-transposed", f"bg-cvaps-t-{year}.csv")
+            for year in c["years"]
+        ],
+        "outputs": lambda c: [
+            location(c["georoot"], "blocks-demo-adjoined", c["fmt"]),
+            path.join(c["demoroot"], "bgs-long.csv")
+        ] + ([path.join(c["store"], str(c["state"]).zfill(2))] if c.get("store") else [])
+    },
+    "acs-cvap-aggregate": {
+        "after": ["acs-cvap-adjoin-disaggregate"],
+        "parameters": ["state", "georoot", "target", "aggregated", "fmt", "cvap", "lean", "fractional", "crosswalk", "store", "points", "incremental", "layers"],
+        "inputs": lambda c: [
+            path.join(c["store"], str(c["state"]).zfill(2)) if c.get("store")
+            else location(c["georoot"], "blocks-demo-adjoined", c["fmt"]),
+            path.join(c["georoot"], c["target"])
+        ] + [path.join(c["georoot"], layer["target"]) for layer in c.get("layers", [])],
+        "outputs": lambda c: [location(c["georoot"], c["aggregated"], c["fmt"])] + [
+            location(c["georoot"], layer["aggregated"], c["fmt"]) for layer in c.get("layers", [])
+        ]
+    },
+    "districtr-prep": {
+        "after": ["acs-cvap-aggregate"],
+        "parameters": ["georoot", "aggregated", "out", "fmt", "exports", "tolerance", "quantization", "describe"],
+        "inputs": lambda c: [location(c["georoot"], c["aggregated"], c["fmt"])] + (
+            [c["describe"]] if c.get("describe") else []
+        ),
+        "outputs": lambda c: [c["out"]]
+    }
+}
+
+
+def digest(location, known=None):
+    """
+    Hashes the contents of a file, or of every file in a directory. Hashes are
+    reused for files whose size and modification time haven't changed.
+
+    :param location: String; file or directory.
+    :param known: Dictionary; maps file locations to their size, modification
+        time, and hash from a previous run. Updated in place; optional.
+    :return: String; hex digest, or None if the location doesn't exist.
+    """
+    known = {} if known is None else known
+    if not path.exists(location):
+        return None
+
+    files = [location]
+    if path.isdir(location):
+        files = sorted(
+            path.join(root, name)
+            for root, _, names in os.walk(location) for name in names
+        )
+
+    h = hashlib.sha256()
+    for file in files:
+        stat = os.stat(file)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        record = known.get(file)
+
+        if record and record["signature"] == signature:
+            filehash = record["digest"]
+        else:
+            fh = hashlib.sha256()
+            with open(file, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""): fh.update(block)
+            filehash = fh.hexdigest()
+            known[file] = {"signature": signature, "digest": filehash}
+
+        h.update(path.relpath(file, location).encode())
+        h.update(filehash.encode())
+
+    return h.hexdigest()
+
+
+def fingerprint(name, config, known=None):
+    """
+    Fingerprints a stage by its code, parameters, and inputs.
+
+    :param name: String; name of the stage.
+    :param config: Dictionary; pipeline parameters.
+    :param known: Dictionary; previously computed file hashes; optional.
+    :return: String; hex digest.
+    """
+    stage = stages[name]
+    here = path.dirname(path.abspath(__file__))
+    h = hashlib.sha256()
+
+    for file in [f"{name}.py"] + modules:
+        h.update(digest(path.join(here, file), known).encode())
+
+    parameters = {p: config.get(p) for p in stage["parameters"]}
+    h.update(json.dumps(parameters, sort_keys=True).encode())
+
+    for file in stage["inputs"](config):
+        h.update(f"{file}:{digest(file, known)}".encode())
+
+    return h.hexdigest()
+
+
+def order(targets):
+    """
+    Returns the provided stages and every stage they depend on, in the order
+    they should run.
+
+    :param targets: List; names of stages.
+    :return: List of stage names.
+    """
+    ordered = []
+
+    def visit(name):
+        if name in ordered: return
+        for dependency in stages[name]["after"]: visit(dependency)
+        ordered.append(name)
+
+    for name in targets: visit(name)
+    return ordered
+
+
+def run(config, targets=None, force=False, log=None):
+    """
+    Runs the pipeline, skipping stages that are up to date.
+
+    :param config: Dictionary; pipeline parameters, which override `defaults`.
+    :param targets: List; stages to bring up to date, along with the stages they
+        depend on. If not provided, every stage is run; optional.
+    :param force: Boolean; run stages even when they're up to date; optional.
+    :param log: File; where progress and the scripts' output are written. If
+        not provided, they're written to the terminal; optional.
+    :return: List of the stages which were run.
+    """
+    config = dict(defaults, **config)
+    config.setdefault("years", [config["year"]])
+    config.setdefault("cvaproot", config["demoroot"])
+
+    manifest = {"stages": {}, "files": {}}
+    if path.exists(config["manifest"]):
+        with open(config["manifest"]) as f: manifest = json.load(f)
+
+    known = manifest["files"]
+    ran = []
+
+    # Write the full set of parameters somewhere the scripts can find them.
+    handle, settings = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(handle, "w") as f: json.dump(config, f)
+
+    try:
+        for name in order(targets if targets else list(stages)):
+            current = fingerprint(name, config, known)
+            previous = manifest["stages"].get(name, {})
+            outputs = {file: digest(file, known) for file in stages[name]["outputs"](config)}
+
+            if (
+                not force
+                and previous.get("fingerprint") == current
+                and previous.get("outputs") == outputs
+                and all(outputs.values())
+            ):
+                print(f"{name}: up to date.", file=log, flush=True)
+                continue
+
+            print(f"{name}: running.", file=log, flush=True)
+            try:
+                subprocess.run(
+                    [sys.executable, path.join(path.dirname(path.abspath(__file__)), f"{name}.py")],
+                    env=dict(os.environ, PREP_CONFIG=settings),
+                    stdout=log,
+                    stderr=subprocess.STDOUT if log else None,
+                    check=True
+                )
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError(f"{name} exited with status {e.returncode}.") from e
+            ran.append(name)
+
+            # Record the stage's fingerprint and outputs only once it succeeds.
+            # We drop the recorded hashes of its outputs first, since scripts
+            # can rewrite files within the same modification-time tick.
+            outputs = stages[name]["outputs"](config)
+            for file in list(known):
+                if any(file == o or file.startswith(path.join(o, "")) for o in outputs):
+                    del known[file]
+
+            manifest["stages"][name] = {
+                "fingerprint": current,
+                "outputs": {file: digest(file, known) for file in outputs}
+            }
+
+            directory = path.dirname(config["manifest"])
+            if directory and not path.exists(directory): os.makedirs(directory)
+            with open(config["manifest"], "w") as f: json.dump(manifest, f, indent=2)
+    finally:
+        os.remove(settings)
+
+    return ran
+
+
+def localize(config, fips):
+    """
+    Creates the parameters for a single state in a batch: files are kept in a
+    directory for the state, e.g. `data/55/geometries/`, and any parameters
+    listed for the state under the config's "states" key are applied. National
+    files (the CVAP special tabulation) stay where they are. Files a state's
+    scripts write outside those directories, like a saved crosswalk and the
+    aggregation cache, are kept in the state's directory too, so states running
+    at once never share them.
+
+    :param config: Dictionary; batch parameters.
+    :param fips: Integer; state FIPS code.
+    :return: Dictionary of parameters for the state.
+    """
+    code = str(fips).zfill(2)
+    root = path.join(config.get("dataroot", "./data/"), code)
+
+    local = {key: value for key, value in config.items() if key != "states"}
+    local.update({
+        "state": int(fips),
+        "georoot": path.join(root, "geometries", ""),
+        "demoroot": path.join(root, "demographics", ""),
+        "out": path.join(root, "out", ""),
+        "manifest": path.join(root, ".pipeline.json"),
+        "cache": path.join(root, ".cache", ""),
+        "cvaproot": config.get("cvaproot", config.get("demoroot", defaults["demoroot"]))
+    })
+    if config.get("reports"): local["reports"] = path.join(root, "reports", "")
+    if config.get("crosswalk"): local["crosswalk"] = path.join(root, path.basename(config["crosswalk"]))
+    local.update(config.get("states", {}).get(code, {}))
+
+    return local
+
+
+def limit(memory):
+    """
+    Limits the memory available to a worker process and the scripts it runs.
+
+    :param memory: Number; gigabytes of address space available. If None, the
+        process isn't limited.
+    """
+    if memory:
+        size = int(memory * 1024**3)
+        resource.setrlimit(resource.RLIMIT_AS, (size, size))
+
+
+def runstate(config, fips, targets=None, force=False):
+    """
+    Runs the pipeline for a single state in a batch, writing its output to a log
+    file in the state's directory. Errors are caught and reported rather than
+    raised, so one state's failure doesn't affect the others.
+
+    :param config: Dictionary; batch parameters.
+    :param fips: Integer; state FIPS code.
+    :param targets: List; stages to bring up to date; optional.
+    :param force: Boolean; run stages even when they're up to date; optional.
+    :return: Tuple of the state FIPS code, the stages run, and an error message
+        (or None).
+    """
+    local = localize(config, fips)
+    root = path.dirname(local["manifest"])
+    for directory in [root, local["georoot"], local["demoroot"]]:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path.join(root, "pipeline.log"), "a") as log:
+        try:
+            return fips, run(local, targets, force, log), None
+        except Exception:
+            error = traceback.format_exc()
+            log.write(error)
+            return fips, [], error.strip().split("\n")[-1]
+
+
+def isolate(config, fips, targets=None, force=False, memory=None):
+    """
+    Runs the pipeline for a single state in a batch in its own worker process,
+    limited to the provided amount of memory, so a worker killed outright (e.g.
+    for exceeding its limit) only fails its own state.
+
+    :param config: Dictionary; batch parameters.
+    :param fips: Integer; state FIPS code.
+    :param targets: List; stages to bring up to date; optional.
+    :param force: Boolean; run stages even when they're up to date; optional.
+    :param memory: Number; gigabytes of memory available to the state;
+        optional.
+    :return: Tuple of the state FIPS code, the stages run, and an error message
+        (or None).
+    """
+    try:
+        with ProcessPoolExecutor(max_workers=1, initializer=limit, initargs=(memory,)) as pool:
+            return pool.submit(runstate, config, fips, targets, force).result()
+    except Exception as e:
+        return fips, [], f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+
+
+def batch(config, states, targets=None, force=False, workers=None, memory=None):
+    """
+    Runs the pipeline for each of the provided states, a few at a time, each in
+    its own worker process limited to the provided amount of memory. One
+    state's failure, even a crash, doesn't affect the others; every failure is
+    reported at the end.
+
+    :param config: Dictionary; batch parameters.
+    :param states: List; state FIPS codes.
+    :param targets: List; stages to bring up to date; optional.
+    :param force: Boolean; run stages even when they're up to date; optional.
+    :param workers: Integer; number of states run at once. Defaults to the
+        number of processors; optional.
+    :param memory: Number; gigabytes of memory available to each state;
+        optional.
+    :return: Dictionary mapping state FIPS codes to error messages for the
+        states which failed.
+    """
+    failures = {}
+
+    workers = workers if workers else os.cpu_count()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(isolate, config, fips, targets, force, memory) for fips in states]
+
+        for future in futures:
+            fips, ran, error = future.result()
+            if error:
+                failures[fips] = error
+                print(f"{str(fips).zfill(2)}: failed ({error}).")
+            else:
+                print(f"{str(fips).zfill(2)}: ran {len(ran)} stages.")
+
+    if failures:
+        print(f"{len(failures)} of {len(states)} states failed: " + ", ".join(
+            f"{str(fips).zfill(2)} ({error})" for fips, error in failures.items()
+        ))
+
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the data preparation pipeline.")
+    parser.add_argument("config", nargs="?", help="JSON file of pipeline parameters.")
+    parser.add_argument("--stages", nargs="+", choices=list(stages), help="Stages to bring up to date.")
+    parser.add_argument("--force", action="store_true", help="Run stages even if they're up to date.")
+    parser.add_argument("--states", nargs="+", type=int, help="State FIPS codes to run in a batch.")
+    parser.add_argument("--workers", type=int, help="Number of states to run at once.")
+    parser.add_argument("--memory", type=float, help="Gigabytes of memory available to each state.")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as f: config = json.load(f)
+
+    if args.states:
+        failures = batch(config, args.states, args.stages, args.force, args.workers, args.memory)
+        sys.exit(1 if failures else 0)
+
+    run(config, args.stages, args.force)
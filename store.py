@@ -0,0 +1,175 @@
+
+import json
+import os
+from os import path
+from shutil import rmtree
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from geometry import county, read, region
+from instrument import phase
+
+
+class Store:
+    """
+    A durable store of block-level data (GEOIDs, prorated demographics, and
+    geometries) partitioned by state and county, so later steps can read only
+    the blocks they need. Each county is a GeoParquet file, at
+    `<root>/<state FIPS>/<county FIPS>.parquet`, and each state has an index
+    recording its counties' bounding boxes, so queries by area only open the
+    counties they overlap. Many states can share a store, e.g.
+
+        store = Store("./data/blocks/")
+        store.write(blocks)
+        wards = store.query(mask=city, columns=["TOTPOP19", "VAP19"])
+    """
+
+    def __init__(self, root):
+        """
+        :param root: String; directory holding the store.
+        """
+        self.root = root
+
+    def location(self, key):
+        """
+        Returns the location of a county's file.
+
+        :param key: String; five-digit county FIPS code.
+        :return: String; file location.
+        """
+        return path.join(self.root, key[:2], f"{key}.parquet")
+
+    def states(self):
+        """
+        Returns the states in the store.
+
+        :return: List of two-digit state FIPS codes.
+        """
+        if not path.isdir(self.root): return []
+        return sorted(
+            state for state in os.listdir(self.root)
+            if path.exists(path.join(self.root, state, "index.json"))
+        )
+
+    def index(self, state):
+        """
+        Returns a state's index, which records the CRS and columns of its
+        blocks, and the number of blocks in (and bounding box of) each county.
+
+        :param state: String; two-digit state FIPS code.
+        :return: Dictionary.
+        """
+        location = path.join(self.root, state, "index.json")
+        if not path.exists(location):
+            return {"crs": None, "columns": [], "counties": {}}
+
+        with open(location) as f: return json.load(f)
+
+    def clear(self, state):
+        """
+        Removes a state's blocks from the store.
+
+        :param state: Integer or string; state FIPS code.
+        """
+        directory = path.join(self.root, str(state).zfill(2))
+        if path.exists(directory): rmtree(directory)
+
+    def write(self, blocks, by="GEOID"):
+        """
+        Writes blocks to the store, replacing the counties they're in.
+
+        :param blocks: Geodataframe; blocks, with GEOIDs.
+        :param by: String; GEOID column; optional.
+        """
+        counties = county(blocks[by]).astype(str).str.zfill(5)
+
+        with phase("write block store", rows=len(blocks)):
+            indices = {}
+            for key, piece in blocks.groupby(counties, sort=False):
+                state = key[:2]
+                if state not in indices:
+                    os.makedirs(path.join(self.root, state), exist_ok=True)
+                    indices[state] = self.index(state)
+
+                piece.to_parquet(self.location(key), index=False)
+                indices[state]["counties"][key] = {
+                    "rows": len(piece), "bounds": list(piece.total_bounds)
+                }
+
+            for state, index in indices.items():
+                index["crs"] = blocks.crs.to_wkt() if blocks.crs else None
+                index["columns"] = list(blocks.columns)
+                with open(path.join(self.root, state, "index.json"), "w") as f:
+                    json.dump(index, f, indent=2)
+
+    def columns(self):
+        """
+        Returns the names of the columns stored for every block.
+
+        :return: List of column names.
+        """
+        names = [self.index(state)["columns"] for state in self.states()]
+        return [column for column in names[0] if all(column in n for n in names)] if names else []
+
+    def counties(self, fips=None, bbox=None, mask=None):
+        """
+        Returns the counties which match the provided FIPS codes and overlap
+        the provided bounding box or mask.
+
+        :param fips: Integer, string, or list of them; two-digit state or
+            five-digit county FIPS codes. If not provided, every county
+            matches; optional.
+        :param bbox: Tuple; (minx, miny, maxx, maxy) bounding box, in the
+            blocks' coordinates; optional.
+        :param mask: Geometry, GeoSeries, or geodataframe; optional.
+        :return: List of five-digit county FIPS codes.
+        """
+        fips = fips if isinstance(fips, (list, tuple)) else [] if fips is None else [fips]
+        fips = [str(f).zfill(2) if len(str(f)) <= 2 else str(f).zfill(5) for f in fips]
+
+        matched = []
+        for state in self.states():
+            if fips and not any(f[:2] == state for f in fips): continue
+
+            index = self.index(state)
+            area = region(bbox, mask, index["crs"])
+            for key, entry in index["counties"].items():
+                if fips and not any(key.startswith(f) for f in fips): continue
+                if area is not None and not shapely.intersects(shapely.box(*entry["bounds"]), area): continue
+                matched.append(key)
+
+        return matched
+
+    def query(self, fips=None, bbox=None, mask=None, columns=None):
+        """
+        Reads blocks from the store, opening only the counties which match the
+        provided FIPS codes and overlap the provided bounding box or mask. Only
+        the requested columns, and only blocks intersecting the bounding box or
+        mask, are loaded.
+
+        :param fips: Integer, string, or list of them; two-digit state or
+            five-digit county FIPS codes. If not provided, blocks from every
+            state are read; optional.
+        :param bbox: Tuple; (minx, miny, maxx, maxy) bounding box, in the
+            blocks' coordinates; optional.
+        :param mask: Geometry, GeoSeries, or geodataframe. GeoSeries and
+            geodataframes are reprojected to match the blocks; optional.
+        :param columns: List; columns to load, in addition to the geometry
+            column. If not provided, all columns are loaded; optional.
+        :return: Geodataframe.
+        """
+        with phase("query block store") as record:
+            keys = self.counties(fips, bbox, mask)
+            record["counties"] = len(keys)
+
+            pieces = [read(self.location(key), columns, bbox, mask) for key in keys]
+            if not pieces:
+                names = columns if columns is not None else self.columns()
+                return gpd.GeoDataFrame(columns=list(dict.fromkeys(list(names) + ["geometry"])), geometry="geometry")
+
+            blocks = gpd.GeoDataFrame(pd.concat(pieces, ignore_index=True), crs=pieces[0].crs)
+            record["rows"] = len(blocks)
+
+        return blocks
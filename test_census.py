@@ -0,0 +1,189 @@
+
+import json
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlparse
+
+import census
+
+"""
+Tests the Census API client against a stub server on localhost, which answers
+each request according to a script of failures, so retries, timeouts, and the
+response cache can be checked without network access. Run with
+
+    python -m unittest test_census
+"""
+
+rows = [["B01001_001E", "state", "county"], ["1000", "55", "001"]]
+
+# Counties, and the block groups in each, answered by `geographic`.
+counties = {"001": ["1", "2"], "003": ["1", "2", "3"]}
+
+
+def geographic(params):
+    """
+    Answers queries for Wisconsin's counties, or for the block groups in one of
+    them, like the API does: each requested variable's value encodes the
+    variable's position in the full list and the block group, so rows which
+    are joined wrongly are caught. Block groups come back rotated by the first
+    variable's number, so chunks of variables list them in different orders.
+    """
+    variables = params["get"].split(",")
+    level, value = params["for"].split(":")
+    parents = dict(part.split(":") for part in params.get("in", "").split(" ") if part)
+
+    if level == "county":
+        return [variables + ["state", "county"]] + [
+            [f"County {county}" for _ in variables] + ["55", county] for county in counties
+        ]
+
+    county = parents["county"]
+    groups = counties[county] if value == "*" else [value]
+    shift = int(variables[0].split("_")[1]) % len(groups)
+    groups = groups[shift:] + groups[:shift]
+
+    return [variables + ["state", "county", "block group"]] + [
+        [str(int(v.split("_")[1]) * 1000 + int(county) * 10 + int(g)) for v in variables] + ["55", county, g]
+        for g in groups
+    ]
+
+
+class Stub(BaseHTTPRequestHandler):
+    """
+    Answers requests with the next behavior in the server's script: "ok" sends
+    the rows, "drop" closes the connection partway through the body, "stall"
+    waits longer than the client's timeout, and a number sends that status.
+    Once the script runs out, every request is answered with the rows, or by
+    the server's answer function, given the query parameters.
+    """
+
+    def do_GET(self):
+        self.server.requests += 1
+        behavior = self.server.script.pop(0) if self.server.script else "ok"
+
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        self.server.queries.append(params)
+        body = json.dumps(self.server.answer(params) if self.server.answer else rows).encode()
+
+        if isinstance(behavior, int):
+            self.send_response(behavior)
+            self.end_headers()
+            return
+
+        if behavior == "stall":
+            time.sleep(1)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if behavior == "drop":
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRequest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Stub)
+        self.server.script, self.server.requests = [], 0
+        self.server.queries, self.server.answer = [], None
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.cache = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache.cleanup()
+
+    def download(self, geography=[("state", "55"), ("county", "001")], cols=["B01001_001E"], **kwargs):
+        arguments = dict(cache=self.cache.name, backoff=0, timeout=0.25, url=self.url)
+        arguments.update(kwargs)
+        return census.download("acs5", 2019, geography, cols, **arguments)
+
+    def test_retries_dropped_stalled_and_failed_requests(self):
+        self.server.script = ["drop", "stall", 503, "ok"]
+        data = self.download()
+
+        self.assertEqual(self.server.requests, 4)
+        self.assertEqual(data["B01001_001E"].tolist(), [1000])
+
+    def test_gives_up_after_retries(self):
+        self.server.script = ["drop"] * 3
+        with self.assertRaises(Exception):
+            self.download(retries=2)
+
+        self.assertEqual(self.server.requests, 3)
+
+    def test_does_not_retry_malformed_requests(self):
+        self.server.script = [400]
+        with self.assertRaises(HTTPError):
+            self.download()
+
+        self.assertEqual(self.server.requests, 1)
+
+    def test_caches_responses(self):
+        first = self.download()
+        second = self.download()
+
+        self.assertEqual(self.server.requests, 1)
+        self.assertTrue(first.equals(second))
+
+    def test_failures_are_not_cached(self):
+        self.server.script = ["drop"]
+        with self.assertRaises(Exception):
+            self.download(retries=0)
+
+        self.download()
+        self.assertEqual(self.server.requests, 2)
+
+    def test_requests_each_county_separately(self):
+        self.server.answer = geographic
+        data = self.download(geography=[("state", "55"), ("county", "*"), ("block group", "*")], cols=["V_1"])
+
+        # One query for the list of counties, then one for each county.
+        self.assertEqual(self.server.queries[0]["for"], "county:*")
+        self.assertEqual(self.server.queries[0]["get"], "NAME")
+        self.assertEqual(
+            sorted(q["in"] for q in self.server.queries[1:]),
+            ["state:55 county:001", "state:55 county:003"]
+        )
+        self.assertTrue(all(q["for"] == "block group:*" for q in self.server.queries[1:]))
+
+        self.assertEqual(len(data), sum(len(groups) for groups in counties.values()))
+        self.assertEqual(sorted(data["V_1"]), [1011, 1012, 1031, 1032, 1033])
+
+    def test_splits_and_joins_many_variables(self):
+        self.server.answer = geographic
+        cols = [f"V_{i}" for i in range(1, 121)]
+        data = self.download(geography=[("state", "55"), ("county", "003"), ("block group", "*")], cols=cols)
+
+        # 120 variables take three requests of at most 50 each.
+        chunks = [q["get"].split(",") for q in self.server.queries]
+        self.assertEqual(sorted(len(chunk) for chunk in chunks), [20, 50, 50])
+        self.assertEqual(sorted(sum(chunks, []), key=lambda v: int(v.split("_")[1])), cols)
+
+        # Every row's values belong to the same block group, though each chunk
+        # listed the block groups in a different order.
+        self.assertEqual(list(data), cols)
+        self.assertEqual(len(data), 3)
+        for _, row in data.iterrows():
+            groups = {value - int(col.split("_")[1]) * 1000 for col, value in row.items()}
+            self.assertEqual(len(groups), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()